@@ -3,26 +3,130 @@
 # Copyright (c) 2015 Grzegorz Chrupała
 # A simple encoder-decoder example with funktional
 from __future__ import division 
+import argparse
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Stacked recurrent autoencoder for sentences.')
+    subparsers = parser.add_subparsers(title='Commands',
+                                       dest='command',
+                                       description='Valid commands',
+                                       help='Additional help')
+
+    parser_train = subparsers.add_parser('train', help='Train a new model from data')
+    parser_train.add_argument('--size',   type=int, default=512,       help='Size of embeddings and hidden layers')
+    parser_train.add_argument('--depth',  type=int, default=2,         help='Number of hidden layers')
+    parser_train.add_argument('--epochs', type=int, default=1,         help='Number of training epochs')
+    parser_train.add_argument('--batch_size', type=int, default=128,   help='Number of examples in minibatch')
+    parser_train.add_argument('--bucket_width', type=int, default=5,   help='Range of sentence lengths grouped in one bucket')
+    parser_train.add_argument('--max_tokens', type=int, default=None,  help='Maximum number of padded tokens in minibatch')
+    parser_train.add_argument('--prefetch', type=int, default=4,       help='Number of minibatches prepared in the background (0 to disable)')
+    parser_train.add_argument('--prefetch_workers', type=int, default=1, help='Number of threads preparing minibatches')
+    parser_train.add_argument('--prefetch_processes', action='store_true', help='Prepare minibatches in processes instead of threads')
+    parser_train.add_argument('--seed',   type=int, default=None,      help='Random seed')
+    parser_train.add_argument('--log',    type=str, default='log.txt', help='Path to log file')
+    parser_train.add_argument('--model_path', type=str, default='.',       help='Path to model directory')
+    parser_train.add_argument('--workers', type=int, default=1,        help='Number of processes for building the vocabulary')
+    parser_train.add_argument('--cache_dir', type=str, default=None,     help='Path to cache of compiled functions')
+    parser_train.add_argument('--prepared', action='store_true',        help='Use data and mapper written to model directory by prepare')
+    parser_train.add_argument('--output', choices=['softmax', 'sampled', 'class'], default='softmax',
+                              help='Output layer: full, sampled or class-based softmax')
+    parser_train.add_argument('--num_sampled', type=int, default=512,   help='Number of words sampled for sampled softmax')
+    parser_train.add_argument('--flat_adam', action='store_true',       help='Keep Adam moment estimates in flat buffers with one fused update')
+    parser_train.add_argument('--sparse_adam', action='store_true',     help='Update only the embedding rows used in each minibatch')
+    parser_train.add_argument('--data_workers', type=int, default=1,    help='Number of processes computing gradients on shards of each minibatch')
+    parser_train.add_argument('train_file',    type=str, nargs='?',         help='Path to training data')
+    parser_train.add_argument('valid_file',    type=str, nargs='?',         help='Path to validation data')
+    parser_train.add_argument('--train_file_out', type=str, default=None,   help='Path to training data output (unless same as input)')
+    parser_train.add_argument('--valid_file_out', type=str, default=None,   help='Path to validation data output (unless same as input')
+    parser_prep = subparsers.add_parser('prepare', help='Build vocabulary and write id-mapped data to model directory')
+    parser_prep.add_argument('--workers', type=int, default=1,         help='Number of processes for building the vocabulary')
+    parser_prep.add_argument('model_path',     type=str,               help='Path to model directory')
+    parser_prep.add_argument('train_file',     type=str,               help='Path to training data')
+    parser_prep.add_argument('valid_file',     type=str,               help='Path to validation data')
+    parser_prep.add_argument('--train_file_out', type=str, default=None, help='Path to training data output (unless same as input)')
+    parser_prep.add_argument('--valid_file_out', type=str, default=None, help='Path to validation data output (unless same as input')
+    parser_proj = subparsers.add_parser('encode', help='Encode data using trained model')
+    parser_proj.add_argument('model_path',     type=str,               help='Path to model')
+    parser_proj.add_argument('input_file',     type=str,               help='Path to data')
+    parser_proj.add_argument('output_file',    type=str,               help='Path to output data')
+    parser_proj.add_argument('--stream', action='store_true',          help='Encode in batches, writing to a .npy file')
+    parser_proj.add_argument('--batch_size', type=int, default=128,    help='Number of examples in minibatch')
+    parser_proj.add_argument('--cache_dir', type=str, default=None,   help='Path to cache of compiled functions')
+    parser_proj.add_argument('--numpy', action='store_true',           help='Use the NumPy model written by export, without compiling')
+    parser_export = subparsers.add_parser('export', help='Write NumPy copy of trained model for inference')
+    parser_export.add_argument('model_path',   type=str,               help='Path to model')
+    parser_gen = subparsers.add_parser('generate', help='Generate output sentences using trained model')
+    parser_gen.add_argument('model_path',     type=str,               help='Path to model')
+    parser_gen.add_argument('input_file',     type=str,               help='Path to data')
+    parser_gen.add_argument('output_file',    type=str,               help='Path to output sentences')
+    parser_gen.add_argument('--beam_size', type=int, default=1,       help='Number of hypotheses kept (1 for greedy search)')
+    parser_gen.add_argument('--max_len', type=int, default=50,        help='Maximum length of output sentences')
+    parser_gen.add_argument('--batch_size', type=int, default=128,    help='Number of examples in minibatch')
+    parser_serve = subparsers.add_parser('serve', help='Serve encodings of sentences using trained model')
+    parser_serve.add_argument('model_path',   type=str,               help='Path to model')
+    parser_serve.add_argument('--host', type=str, default='localhost', help='Host to listen on')
+    parser_serve.add_argument('--port', type=int, default=8000,       help='Port to listen on')
+    parser_serve.add_argument('--batch_size', type=int, default=128,  help='Maximum number of sentences in minibatch')
+    parser_serve.add_argument('--max_latency', type=float, default=10.0, help='Maximum time in ms a sentence waits for its minibatch to fill')
+    parser_serve.add_argument('--bucket_width', type=int, default=5,  help='Range of sentence lengths grouped in one minibatch')
+    parser_index = subparsers.add_parser('index', help='Add encodings of sentences to a nearest-neighbour index')
+    parser_index.add_argument('model_path',   type=str,               help='Path to model')
+    parser_index.add_argument('input_file',   type=str,               help='Path to data')
+    parser_index.add_argument('index_path',   type=str,               help='Path to index directory (created if missing)')
+    parser_index.add_argument('--lists', type=int, default=None,      help='Number of lists of a new index (default: square root of number of sentences)')
+    parser_index.add_argument('--batch_size', type=int, default=128,  help='Number of examples in minibatch')
+    parser_search = subparsers.add_parser('search', help='Find indexed sentences nearest to input sentences')
+    parser_search.add_argument('model_path',  type=str,               help='Path to model')
+    parser_search.add_argument('index_path',  type=str,               help='Path to index directory')
+    parser_search.add_argument('input_file',  type=str,               help='Path to data')
+    parser_search.add_argument('output_file', type=str,               help='Path to output ids and similarities')
+    parser_search.add_argument('--k', type=int, default=10,           help='Number of neighbours')
+    parser_search.add_argument('--n_probe', type=int, default=8,      help='Number of lists searched')
+    parser_search.add_argument('--batch_size', type=int, default=128, help='Number of examples in minibatch')
+    args = parser.parse_args(argv)
+    if args.command == 'train' and not args.prepared and (args.train_file is None or args.valid_file is None):
+        parser.error('train_file and valid_file are required unless --prepared is given')
+    if args.command == 'train' and args.data_workers > 1 and args.sparse_adam:
+        parser.error('--sparse_adam cannot be used with --data_workers')
+    if args.command == 'train' and args.sparse_adam and args.output == 'softmax':
+        parser.error('--sparse_adam needs --output sampled or class, as the softmax output uses all embeddings')
+    return args
+
+if __name__ == '__main__':
+    # Parse arguments before importing Theano, so that --help and usage
+    # errors do not wait for it
+    args = parse_args()
+
 import theano
 import numpy
 import random
 import itertools
 import cPickle as pickle
-import argparse
 import gzip
 import sys
 import os
 import funktional.util as util
+import funktional.inference as inference
+import funktional.corpus as corpus
+import funktional.checkpoint as checkpoint
+import funktional.context as context
 import copy
 import time
 from funktional.layer import *
 
 class EncoderDecoder(Layer):
-    """A simple encoder-decoder net with shared input and output vocabulary."""
-    def __init__(self, size_vocab, size, depth):
+    """A simple encoder-decoder net with shared input and output vocabulary.
+
+    The output layer is a full softmax (`output='softmax'`), a sampled
+    softmax over `num_sampled` words during training (`'sampled'`), or a
+    class-based softmax (`'class'`). Sampled softmax and class-based
+    softmax use the word frequencies `freq` if given.
+    """
+    def __init__(self, size_vocab, size, depth, output='softmax', num_sampled=512, freq=None):
         self.size_vocab  = size_vocab
         self.size     = size
         self.depth    = depth
+        self.output   = output
         self.Embed    = Embedding(self.size_vocab, self.size)
         encoder = lambda size_in, size: StackedGRUH0(size_in, size, self.depth)
         decoder = lambda size_in, size: StackedGRU(size_in, size, self.depth)
@@ -30,37 +134,181 @@ class EncoderDecoder(Layer):
                                           encoder=encoder,
                                           decoder=decoder)
         self.Out      = Dense(size_in=self.size, size_out=self.size)
-        self.params   = self.Embed.params + self.Encdec.params + self.Out.params
+        if self.output == 'sampled':
+            self.Output = SampledSoftmax(self.Embed, num_sampled=num_sampled, freq=freq)
+        elif self.output == 'class':
+            self.Output = ClassSoftmax(self.size, self.size_vocab, freq=freq)
+        else:
+            self.Output = Softmax(self.Embed)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'Output' not in state:
+            self.output = 'softmax'
+            self.Output = Softmax(self.Embed)
+
+    def params(self):
+        return params(self.Embed, self.Encdec, self.Out, self.Output)
 
-    def __call__(self, inp, out_prev):
-        return softmax3d(self.Embed.unembed(self.Out(self.Encdec(self.Embed(inp), self.Embed(out_prev)))))
+    def states(self, inp, out_prev, mask_inp=None, mask_out=None):
+        return self.Out(self.Encdec(self.Embed(inp), self.Embed(out_prev), mask_inp=mask_inp, mask_out=mask_out))
+
+    def __call__(self, inp, out_prev, mask_inp=None, mask_out=None):
+        return self.Output(self.states(inp, out_prev, mask_inp=mask_inp, mask_out=mask_out))
+
+    def log_probs(self, inp, out_prev, mask_inp=None, mask_out=None):
+        return self.Output.log_probs(self.states(inp, out_prev, mask_inp=mask_inp, mask_out=mask_out))
+
+    def cost(self, inp, out_prev, out, mask_inp=None, mask_out=None):
+        """Training cost of the output layer."""
+        return self.Output.cost(self.states(inp, out_prev, mask_inp=mask_inp, mask_out=mask_out), out, mask=mask_out)
+
+    def decode_init(self, inp, mask_inp=None):
+        return self.Encdec.decode_init(self.Embed(inp), mask_inp=mask_inp)
+
+    def decode_step(self, out_prev_t, states):
+        """Return log-probabilities of the next output symbol, and the new decoder states."""
+        h_t, states = self.Encdec.decode_step(self.Embed(out_prev_t), states)
+        return (self.Output.log_probs(self.Out(h_t)), states)
 
 class Model(object):
-    """Trainable encoder-decoder model."""
-    def __init__(self, size_vocab, size, depth):
+    """Trainable encoder-decoder model. If `cache` is given, compiled
+    functions are looked up in and stored to this `FunctionCache`. The
+    output layer is chosen by `output`, as for `EncoderDecoder`; `loss`
+    always computes the full softmax cross-entropy. Parameters are
+    updated by `updater`, by default Adam. `arch` records the arguments
+    needed to rebuild the model from a checkpoint."""
+    def __init__(self, size_vocab, size, depth, cache=None, output='softmax', num_sampled=512, freq=None,
+                 updater=None):
         self.size = size
         self.size_vocab = size_vocab
         self.depth = depth
-        self.network = EncoderDecoder(self.size_vocab, self.size, self.depth)
+        self.network = EncoderDecoder(self.size_vocab, self.size, self.depth,
+                                      output=output, num_sampled=num_sampled, freq=freq)
         self.input       = T.imatrix()
         self.output_prev = T.imatrix()
         self.output      = T.imatrix()
-        self.projection  = last(self.network.Encdec.Encode(self.network.Embed(self.input)))
-        OH = OneHot(size_in=self.size_vocab)
-        self.output_oh   = OH(self.output)
-        self.output_pred = self.network(self.input, self.output_prev)
-        self.cost = CrossEntropy(self.output_oh, self.output_pred)
-        self.updater = Adam()
-        self.updates = self.updater.get_updates(self.network.params, self.cost)
-        self.train = theano.function([self.input, self.output_prev, self.output ], 
-                                      self.cost, updates=self.updates)
-        self.predict = theano.function([self.input, self.output_prev], self.output_pred)
-        self.project = theano.function([self.input], self.projection)
-        # Like train, but no updates
-        self.loss = theano.function([self.input, self.output_prev, self.output ], self.cost)
+        self.mask_inp    = T.matrix()
+        self.mask_out    = T.matrix()
+        self.projection  = last(self.network.Encdec.Encode(self.network.Embed(self.input), mask=self.mask_inp))
+        self.output_pred = self.network(self.input, self.output_prev, mask_inp=self.mask_inp, mask_out=self.mask_out)
+        self.loss_full = SparseCrossEntropy(self.output, self.network.log_probs(self.input, self.output_prev,
+                                                                                mask_inp=self.mask_inp,
+                                                                                mask_out=self.mask_out),
+                                            mask=self.mask_out)
+        self.cost = self.network.cost(self.input, self.output_prev, self.output,
+                                      mask_inp=self.mask_inp, mask_out=self.mask_out)
+        self.updater = Adam() if updater is None else updater
+        self.updates = self.updater.get_updates(self.network.params(), self.cost)
+        self.freq = freq
+        self.arch = dict(size_vocab=self.size_vocab, size=self.size, depth=self.depth,
+                         output=output, num_sampled=num_sampled, updater=dict(self.updater.__dict__))
+        spec = dict(model='autoencoder', size_vocab=self.size_vocab, size=self.size, depth=self.depth,
+                    output=output, num_sampled=num_sampled,
+                    updater=sorted(self.updater.__dict__.items()))
+        from funktional.cache import functions as compile_functions
+        fns = compile_functions(cache, spec,
+            train=([self.input, self.output_prev, self.output, self.mask_inp, self.mask_out],
+                   self.cost, self.updates),
+            predict=([self.input, self.output_prev, self.mask_inp, self.mask_out], self.output_pred),
+            project=([self.input, self.mask_inp], self.projection),
+            # Like train, but no updates, and with the full softmax
+            loss=([self.input, self.output_prev, self.output, self.mask_inp, self.mask_out], self.loss_full))
+        self.train   = fns['train']
+        self.predict = fns['predict']
+        self.project = fns['project']
+        self.loss    = fns['loss']
+
+    def state(self):
+        """Return the shared variables holding the state of the updater."""
+        params = self.network.params()
+        return [ s for s, _ in self.updates if s not in params ]
+
+    def arrays(self):
+        """Return the named arrays stored in a checkpoint: parameters,
+        updater state and word frequencies."""
+        arrays = [ ('param.{}'.format(i), p.get_value(borrow=True)) for i, p in enumerate(self.network.params()) ] + \
+                 [ ('state.{}'.format(i), s.get_value(borrow=True)) for i, s in enumerate(self.state()) ]
+        if self.freq is not None:
+            arrays.append(('freq', numpy.asarray(self.freq)))
+        return arrays
+
+    def data_parallel(self, workers):
+        """Return a function training like `train`, with each minibatch
+        split across `workers` processes. The updater then applies the
+        averaged gradients, continuing from its current state."""
+        import funktional.parallel as parallel
+        inputs = [self.input, self.output_prev, self.output, self.mask_inp, self.mask_out]
+        params = self.network.params()
+        grad = theano.function(inputs, [self.cost] + T.grad(self.cost, params))
+        grads = [ p.type() for p in params ]
+        state = self.state()
+        self.updates = self.updater.get_updates(params, None, grads=grads)
+        for old, new in zip(state, self.state()):
+            new.set_value(old.get_value())
+        apply = theano.function(grads, [], updates=self.updates)
+        # The cost is the mean over output tokens
+        return parallel.DataParallel(grad, apply, params, workers=workers, weight=lambda shard: shard[4].sum())
+
+    def decoder(self):
+        """Return functions computing the initial decoder states and
+        one decoding step, compiling them on first use."""
+        if getattr(self, '_decoder', None) is None:
+            prev = T.ivector()
+            states = [ T.matrix() for _ in self.network.Encdec.Decode.stream_init(1) ]
+            with context.context(training=False):
+                init = self.network.decode_init(self.input, mask_inp=self.mask_inp)
+                logp, new_states = self.network.decode_step(prev, states)
+            self._decoder = (theano.function([self.input, self.mask_inp], init),
+                             theano.function([prev] + states, [logp] + new_states))
+        return self._decoder
+
+    def generate(self, inp, mask_inp, BEG, END, beam_size=1, max_len=50):
+        """Generate output sequences for input `inp`, encoding it once and
+        decoding step by step with beam search (greedy search if
+        `beam_size` is 1). Returns the sequences and their log-probabilities."""
+        import funktional.search as search
+        init, step = self.decoder()
+        def decode_step(prev, states):
+            out = step(prev, *states)
+            return (out[0], out[1:])
+        return search.beam_search(decode_step, init(inp, mask_inp), BEG, END, size=beam_size, max_len=max_len)
+
+class InferenceModel(object):
+    """NumPy-only copy of a trained Model, supporting `project` and
+    `predict`. Built from a Model by `inference_model`, and saved and
+    loaded by `export_model` and `load_inference_model`."""
+    def __init__(self, size, Embed, Encdec, Out):
+        self.size   = size
+        self.Embed  = Embed
+        self.Encdec = Encdec
+        self.Out    = Out
+
+    def project(self, inp, mask_inp):
+        return inference.last(self.Encdec.Encode(self.Embed(inp), mask=mask_inp))
+
+    def predict(self, inp, out_prev, mask_inp, mask_out):
+        return inference.softmax3d(self.Embed.unembed(self.Out(self.Encdec(self.Embed(inp), self.Embed(out_prev),
+                                                                           mask_inp=mask_inp, mask_out=mask_out))))
         
         
         
+def inference_model(model):
+    """Return InferenceModel copy of `model`."""
+    if not isinstance(model.network.Output, Softmax):
+        raise NotImplementedError("InferenceModel supports only softmax output tied to the embedding")
+    return InferenceModel(model.size, inference.convert(model.network.Embed),
+                          inference.convert(model.network.Encdec), inference.convert(model.network.Out))
+
+def export_model(model, path):
+    """Save the InferenceModel copy of `model` to `path`, as the layers of
+    funktional.inference, which load without Theano."""
+    m = inference_model(model)
+    inference.save(dict(size=m.size, Embed=m.Embed, Encdec=m.Encdec, Out=m.Out), path)
+
+def load_inference_model(path):
+    return InferenceModel(**inference.load(path))
+
 def pad(xss, padding):
     max_len = max((len(xs) for xs in xss))
     def pad_one(xs):
@@ -90,12 +338,39 @@ def batch_para(item, BEG, END):
     out_prev = mb_out[:,0:-1]
     return (inp, out_prev, out)
 
+def batch_mask(item, BEG, END):
+    """Prepare minibatch, together with the mask for padding."""
+    inp, out_prev, out = batch(item, BEG, END)
+    _, mask = util.pad_mask([s+[END] for s in item], END)
+    mask = numpy.array(mask, dtype=theano.config.floatX)
+    return (inp, out_prev, out, mask)
+
+def batch_para_mask(item, BEG, END):
+    """Prepare minibatch, together with the masks for padding in input and output."""
+    inp, out_prev, out = batch_para(item, BEG, END)
+    _, mask_inp = util.pad_mask([s+[END] for s,_ in item], END)
+    _, mask_out = util.pad_mask([r+[END] for _,r in item], END)
+    mask_inp = numpy.array(mask_inp, dtype=theano.config.floatX)
+    mask_out = numpy.array(mask_out, dtype=theano.config.floatX)
+    return (inp, out_prev, out, mask_inp, mask_out)
+
+class BatchMaker(object):
+    """Prepare minibatch from a list of indices into parallel data."""
+    def __init__(self, sents_in, sents_out, BEG, END):
+        self.sents_in  = sents_in
+        self.sents_out = sents_out
+        self.BEG = BEG
+        self.END = END
+
+    def __call__(self, mb):
+        return batch_para_mask([ (self.sents_in[i], self.sents_out[i]) for i in mb ], self.BEG, self.END)
+
 def valid_loss(model, inp, out, BEG, END, batch_size=128):
     costs = 0.0; N = 0
     for _j, item in enumerate(grouper(itertools.izip(inp, out), batch_size)):
         j = _j + 1
-        inp, out_prev, out = batch_para(item, BEG, END)
-        costs = costs + model.loss(inp, out_prev, out) ; N = N + 1
+        inp, out_prev, out, mask_inp, mask_out = batch_para_mask(item, BEG, END)
+        costs = costs + model.loss(inp, out_prev, out, mask_inp, mask_out) ; N = N + 1
     return costs / N
 
 def shuffled(x):
@@ -103,64 +378,72 @@ def shuffled(x):
     random.shuffle(y)
     return y
 
-def main():
-    parser = argparse.ArgumentParser(description='Stacked recurrent autoencoder for sentences.')
-    subparsers = parser.add_subparsers(title='Commands',
-                                       dest='command',
-                                       description='Valid commands',
-                                       help='Additional help')
-
-    parser_train = subparsers.add_parser('train', help='Train a new model from data')
-    parser_train.add_argument('--size',   type=int, default=512,       help='Size of embeddings and hidden layers')
-    parser_train.add_argument('--depth',  type=int, default=2,         help='Number of hidden layers')
-    parser_train.add_argument('--epochs', type=int, default=1,         help='Number of training epochs')
-    parser_train.add_argument('--batch_size', type=int, default=128,   help='Number of examples in minibatch')
-    parser_train.add_argument('--seed',   type=int, default=None,      help='Random seed')
-    parser_train.add_argument('--log',    type=str, default='log.txt', help='Path to log file')
-    parser_train.add_argument('--model_path', type=str, default='.',       help='Path to model directory')
-    parser_train.add_argument('train_file',    type=str,                    help='Path to training data')
-    parser_train.add_argument('valid_file',    type=str,                    help='Path to validation data')
-    parser_train.add_argument('--train_file_out', type=str, default=None,   help='Path to training data output (unless same as input)')
-    parser_train.add_argument('--valid_file_out', type=str, default=None,   help='Path to validation data output (unless same as input')
-    parser_proj = subparsers.add_parser('encode', help='Encode data using trained model')
-    parser_proj.add_argument('model_path',     type=str,               help='Path to model')
-    parser_proj.add_argument('input_file',     type=str,               help='Path to data')
-    parser_proj.add_argument('output_file',    type=str,               help='Path to output data')
-    args = parser.parse_args()
+def main(args):
     if args.command == 'train':
         train_cmd(args)
+    elif args.command == 'prepare':
+        prepare_cmd(args)
     elif args.command == 'encode':
         encode_cmd(args)
+    elif args.command == 'export':
+        export_cmd(args)
+    elif args.command == 'generate':
+        generate_cmd(args)
+    elif args.command == 'serve':
+        serve_cmd(args)
+    elif args.command == 'index':
+        index_cmd(args)
+    elif args.command == 'search':
+        search_cmd(args)
 
 def train_cmd(args):
     if args.seed is not None:
         random.seed(args.seed)
-    mapper = util.IdMapper(min_df=10)
-    text_in      = ( line.split() for line in open(args.train_file) )
-    text_out     = text_in if args.train_file_out is None else ( line.split() for line in open(args.train_file_out) )
-    text_val_in  = (line.split() for line in open(args.valid_file))
-    text_val_out = text_val_in if args.valid_file_out is None else (line.split() for line in open(args.valid_file_out))
-    sents_in      = mapper.fit_transform(text_in)
-    sents_out     = mapper.transform(text_out)
-    sents_val_in  = list(mapper.transform(text_val_in))
-    sents_val_out = list(mapper.transform(text_val_out))
-    sents = shuffled(list(itertools.izip(sents_in, sents_out)))
-    pickle.dump(mapper, gzip.open(os.path.join(args.model_path, 'mapper.pkl.gz'),'w'))
+    if args.prepared:
+        mapper = load_mapper(args.model_path)
+        sents_in, sents_out, sents_val_in, sents_val_out = load_prepared(args.model_path)
+    else:
+        mapper = util.IdMapper(min_df=10)
+        mapper.fit_file(args.train_file, workers=args.workers)
+        read = lambda path: list(mapper.transform(line.split() for line in open(path)))
+        sents_in      = read(args.train_file)
+        sents_out     = sents_in if args.train_file_out is None else read(args.train_file_out)
+        sents_val_in  = read(args.valid_file)
+        sents_val_out = sents_val_in if args.valid_file_out is None else read(args.valid_file_out)
+        save_mapper(mapper, args.model_path)
+    len_in, len_out = corpus.lengths(sents_in), corpus.lengths(sents_out)
     mb_size = 128
-    model = Model(size_vocab=mapper.size(), size=args.size, depth=args.depth)
+    from funktional.cache import FunctionCache
+    fn_cache = None if args.cache_dir is None else FunctionCache(args.cache_dir)
+    freq = mapper.frequencies()
+    model = Model(size_vocab=mapper.size(), size=args.size, depth=args.depth, cache=fn_cache,
+                  output=args.output, num_sampled=args.num_sampled, freq=freq,
+                  updater=Adam(flat=args.flat_adam, sparse=args.sparse_adam))
+    if fn_cache is not None:
+        print "cache", fn_cache.stats()
+    batcher = util.BucketBatcher(width=args.bucket_width, max_tokens=args.max_tokens,
+                                 batch_size=args.batch_size, key=lambda i: max(len_in[i], len_out[i]))
+    saver = checkpoint.AsyncSaver()
+    # Worker processes are forked before the prefetching threads start
+    train = model.train if args.data_workers == 1 else model.data_parallel(args.data_workers)
+    prefetch = util.Prefetcher(BatchMaker(sents_in, sents_out, mapper.BEG_ID, mapper.END_ID),
+                               size=args.prefetch, workers=args.prefetch_workers,
+                               processes=args.prefetch_processes)
     with open(args.log,'w') as log:
         for epoch in range(1,args.epochs + 1):
             costs = 0 ; N = 0
-            for _j, item in enumerate(grouper(sents, args.batch_size)):
+            batcher.reset()
+            prefetch.reset()
+            for _j, mb in enumerate(prefetch(batcher(range(len(sents_in))))):
                 j = _j + 1
-                inp, out_prev, out = batch_para(item, mapper.BEG_ID, mapper.END_ID)
-                costs = costs + try_alloc(lambda: model.train(inp, out_prev, out), attempts=5, pause=10) ; N = N + 1
+                inp, out_prev, out, mask_inp, mask_out = mb
+                costs = costs + try_alloc(lambda: train(inp, out_prev, out, mask_inp, mask_out), attempts=5, pause=10) ; N = N + 1
                 print epoch, j, "train", costs / N
                 if j % 500 == 0:
                     cost_valid = valid_loss(model, sents_val_in, sents_val_out, mapper.BEG_ID, mapper.END_ID, batch_size=args.batch_size)
                     print epoch, j, "valid", cost_valid
                 if j % 100 == 0:
-                    pred = model.predict(inp, out_prev)
+                    pred = model.predict(inp, out_prev, mask_inp, mask_out)
                     for i in range(len(pred)):
                         orig = [ w for w in list(mapper.inverse_transform([inp[i]]))[0] 
                                  if w != mapper.END ]
@@ -171,8 +454,88 @@ def train_cmd(args):
                         log.write("{}".format(' '.join(res)))
                         log.write("\n")
                     log.flush()
-            pickle.dump(model, gzip.open(os.path.join(args.model_path,'model.{0}.pkl.gz'.format(epoch)),'w'))
-    pickle.dump(model, gzip.open(os.path.join(args.model_path, 'model.pkl.gz'), 'w'))
+            print epoch, "padding efficiency", batcher.efficiency()
+            print epoch, "prefetch starvation", prefetch.starvation(), prefetch.wait_time
+            save_model(model, os.path.join(args.model_path, 'model.{0}.ckpt'.format(epoch)), saver=saver)
+    prefetch.close()
+    if args.data_workers > 1:
+        train.close()
+    save_model(model, os.path.join(args.model_path, 'model.ckpt'), saver=saver)
+    saver.wait()
+
+def save_model(model, path, saver=None):
+    """Save parameters, updater state and architecture of `model` to the
+    checkpoint `path`, in the background if an AsyncSaver `saver` is given."""
+    spec = dict(model='autoencoder', arch=model.arch)
+    if saver is None:
+        checkpoint.save(path, spec, model.arrays())
+    else:
+        saver.save(path, spec, model.arrays())
+
+def restore(variables, arrays, prefix):
+    """Return the arrays named `prefix`.i for shared `variables`, checking their shapes."""
+    values = []
+    for i, v in enumerate(variables):
+        a = arrays['{}.{}'.format(prefix, i)]
+        if a.shape != v.get_value(borrow=True).shape:
+            raise ValueError("Checkpoint {}.{} has shape {}, expected {}".format(prefix, i, a.shape, v.get_value(borrow=True).shape))
+        values.append(numpy.asarray(a, dtype=v.dtype))
+    return values
+
+class LegacyModel(object):
+    """Model pickled before masks were introduced. Its compiled `project`
+    takes no mask, so padding is encoded as it was then; this is the only
+    function supported."""
+    def __init__(self, model):
+        self.model = model
+        self.size = model.size
+
+    def project(self, inp, mask):
+        return self.model.project(inp)
+
+    def __getattr__(self, name):
+        raise AttributeError("{} is not supported for models saved before masks were introduced; retrain the model".format(name))
+
+def load_model(model_path, cache=None):
+    """Load the model in `model_path`, rebuilt from the checkpoint model.ckpt
+    if it exists, and otherwise unpickled from model.pkl.gz. Models pickled
+    before masks were introduced are wrapped in LegacyModel."""
+    path = os.path.join(model_path, 'model.ckpt')
+    if not os.path.exists(path):
+        model = pickle.load(gzip.open(os.path.join(model_path, 'model.pkl.gz')))
+        return model if hasattr(model, 'mask_inp') else LegacyModel(model)
+    spec, arrays = checkpoint.load(path)
+    arch = spec['arch']
+    model = Model(size_vocab=arch['size_vocab'], size=arch['size'], depth=arch['depth'], cache=cache,
+                  output=arch['output'], num_sampled=arch['num_sampled'], freq=arrays.get('freq'),
+                  updater=Adam(**arch['updater']))
+    model.network.borrow_params(restore(model.network.params(), arrays, 'param'))
+    for s, value in zip(model.state(), restore(model.state(), arrays, 'state')):
+        s.set_value(value)
+    return model
+
+def save_mapper(mapper, model_path):
+    pickle.dump(mapper, gzip.open(os.path.join(model_path, 'mapper.pkl.gz'),'w'))
+    util.save_vocab(mapper, os.path.join(model_path, 'mapper.vocab'))
+
+def prepare_cmd(args):
+    mapper = util.IdMapper(min_df=10)
+    mapper.fit_file(args.train_file, workers=args.workers)
+    save_mapper(mapper, args.model_path)
+    for name, path in [('train.in', args.train_file), ('train.out', args.train_file_out),
+                       ('valid.in', args.valid_file), ('valid.out', args.valid_file_out)]:
+        if path is not None:
+            corpus.write_corpus(mapper, (line.split() for line in open(path)),
+                                os.path.join(args.model_path, name))
+
+def load_prepared(model_path):
+    """Load corpora written by the prepare command from `model_path`."""
+    def load(name, default=None):
+        prefix = os.path.join(model_path, name)
+        return corpus.Corpus(prefix) if os.path.exists(prefix + '.ids') else default
+    sents_in = load('train.in')
+    sents_val_in = load('valid.in')
+    return (sents_in, load('train.out', sents_in), sents_val_in, load('valid.out', sents_val_in))
 
 def try_alloc(fn, attempts=1, pause=1):
     '''Try executing function `fn`, recovering from MemoryError `attempts` times.'''
@@ -188,13 +551,143 @@ def try_alloc(fn, attempts=1, pause=1):
         
 def encode(model, mapper, sents):
     """Return projections of `sents` to the final hidden state of the encoder of `model`."""
-    return numpy.vstack([  model.project(batch(item, mapper.BEG_ID, mapper.END_ID)[0]) 
-                           for item in grouper(mapper.transform(sents), 128) ])
+    def project(item):
+        inp, _, _, mask = batch_mask(item, mapper.BEG_ID, mapper.END_ID)
+        return model.project(inp, mask)
+    return numpy.vstack([ project(item) for item in grouper(mapper.transform(sents), 128) ])
+
+def encode_stream(model, mapper, input_file, output_file, batch_size=128):
+    """Write projections of sentences in `input_file` to the .npy file `output_file`.
+
+    Sentences are read and projected one batch at a time, and written to
+    a preallocated memory-mapped array. The number of completed rows is
+    recorded in `output_file`.progress after each batch; if this file
+    exists, encoding resumes after the last completed batch.
+    """
+    with open(input_file) as f:
+        N = sum(1 for _ in f)
+    if N == 0:
+        # open_memmap cannot map an empty array
+        with open(output_file, 'wb') as f:
+            numpy.save(f, numpy.zeros((0, model.size), dtype=theano.config.floatX))
+        return
+    progress_file = output_file + '.progress'
+    if os.path.exists(progress_file) and os.path.exists(output_file):
+        with open(progress_file) as f:
+            done = int(f.read())
+        out = numpy.lib.format.open_memmap(output_file, mode='r+')
+        if out.shape != (N, model.size):
+            raise ValueError("Cannot resume: {} has shape {}, expected {}".format(output_file, out.shape, (N, model.size)))
+    else:
+        done = 0
+        out = numpy.lib.format.open_memmap(output_file, mode='w+', dtype=theano.config.floatX, shape=(N, model.size))
+    with open(input_file) as f:
+        sents = ( line.split() for line in itertools.islice(f, done, None) )
+        for item in util.grouper(mapper.transform(sents), batch_size):
+            inp, _, _, mask = batch_mask(item, mapper.BEG_ID, mapper.END_ID)
+            out[done:done+len(item)] = model.project(inp, mask)
+            done = done + len(item)
+            out.flush()
+            write_progress(progress_file, done)
+    del out
+    os.remove(progress_file)
+
+def write_progress(path, done):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(str(done))
+    os.rename(tmp, path)
+
+def load_mapper(model_path):
+    """Load the mapper from `model_path`, preferring the memory-mapped vocabulary."""
+    path = os.path.join(model_path, 'mapper.vocab')
+    if os.path.exists(path):
+        return util.MappedIdMapper(path)
+    else:
+        return pickle.load(gzip.open(os.path.join(model_path, 'mapper.pkl.gz')))
+
 def encode_cmd(args):
-    model = pickle.load(gzip.open(os.path.join(args.model_path, 'model.pkl.gz')))
-    mapper = pickle.load(gzip.open(os.path.join(args.model_path, 'mapper.pkl.gz')))
-    sents = [line.split() for line in open(args.input_file) ]
-    pickle.dump(encode(model, mapper, sents), gzip.open(args.output_file, 'w'))
+    if args.numpy:
+        model = load_inference_model(os.path.join(args.model_path, 'inference.pkl'))
+    else:
+        from funktional.cache import FunctionCache
+        model = load_model(args.model_path, cache=None if args.cache_dir is None else FunctionCache(args.cache_dir))
+    mapper = load_mapper(args.model_path)
+    if args.stream:
+        encode_stream(model, mapper, args.input_file, args.output_file, batch_size=args.batch_size)
+    else:
+        sents = [line.split() for line in open(args.input_file) ]
+        pickle.dump(encode(model, mapper, sents), gzip.open(args.output_file, 'w'))
+
+def export_cmd(args):
+    export_model(load_model(args.model_path), os.path.join(args.model_path, 'inference.pkl'))
+
+def projector(model, mapper):
+    """Return function projecting a list of tokenized sentences with `model`."""
+    def project(sents):
+        inp, _, _, mask = batch_mask(list(mapper.transform(sents)), mapper.BEG_ID, mapper.END_ID)
+        return model.project(inp, mask)
+    return project
+
+def serve_cmd(args):
+    import funktional.serve as serve
+    model = load_model(args.model_path)
+    mapper = load_mapper(args.model_path)
+    batcher = serve.MicroBatcher(projector(model, mapper), max_batch=args.batch_size,
+                                 max_latency=args.max_latency / 1000, bucket_width=args.bucket_width)
+    server = serve.Server((args.host, args.port), batcher)
+    print "Serving on {}:{}".format(args.host, args.port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        batcher.close()
+
+def encode_batches(model, mapper, path, batch_size=128):
+    """Yield projections of sentences in `path`, one batch at a time."""
+    project = projector(model, mapper)
+    for sents in util.grouper((line.split() for line in open(path)), batch_size):
+        yield project(sents)
+
+def index_cmd(args):
+    import funktional.index as index
+    model = load_model(args.model_path)
+    mapper = load_mapper(args.model_path)
+    vectors = numpy.vstack(list(encode_batches(model, mapper, args.input_file, batch_size=args.batch_size)))
+    if os.path.exists(os.path.join(args.index_path, 'index.json')):
+        index.Index(args.index_path).add(vectors)
+    else:
+        index.write_index(args.index_path, vectors, lists=args.lists)
+
+def search_cmd(args):
+    import funktional.index as index
+    model = load_model(args.model_path)
+    mapper = load_mapper(args.model_path)
+    idx = index.Index(args.index_path)
+    with open(args.output_file, 'w') as f:
+        for vectors in encode_batches(model, mapper, args.input_file, batch_size=args.batch_size):
+            ids, scores = idx.search(vectors, k=args.k, n_probe=args.n_probe)
+            for row_ids, row_scores in itertools.izip(ids, scores):
+                f.write(' '.join('{}:{:.4f}'.format(i, s) for i, s in itertools.izip(row_ids, row_scores) if i >= 0))
+                f.write('\n')
+
+def generate(model, mapper, sents, beam_size=1, max_len=50, batch_size=128):
+    """Generate output sentences for `sents` with `model`."""
+    for item in util.grouper(mapper.transform(sents), batch_size):
+        inp, _, _, mask = batch_mask(item, mapper.BEG_ID, mapper.END_ID)
+        outs, _ = model.generate(inp, mask, mapper.BEG_ID, mapper.END_ID, beam_size=beam_size, max_len=max_len)
+        for sent in mapper.inverse_transform(outs):
+            yield sent
+
+def generate_cmd(args):
+    model = load_model(args.model_path)
+    mapper = load_mapper(args.model_path)
+    sents = ( line.split() for line in open(args.input_file) )
+    with open(args.output_file, 'w') as f:
+        for sent in generate(model, mapper, sents, beam_size=args.beam_size, max_len=args.max_len,
+                             batch_size=args.batch_size):
+            f.write(' '.join(sent))
+            f.write('\n')
 
 if __name__ == '__main__':
-    main()
+    main(args)
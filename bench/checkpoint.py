@@ -0,0 +1,63 @@
+# encoding: utf-8
+"""Benchmark the memory/compute trade-off of gradient checkpointing in
+recurrent layers.
+
+For each layer, sequence length and checkpoint interval k, measures peak
+memory and throughput of the forward+backward pass. k=0 means no
+checkpointing, and k=-1 means k is the square root of the sequence length:
+
+    python bench/checkpoint.py --length 100,400 --every 0,-1,10,50
+"""
+from __future__ import print_function
+import argparse
+import numpy
+import theano
+import theano.tensor as T
+from funktional.layer import GRUH0, StackedGRUH0
+from funktional.rhn import RHN0
+import harness
+
+LAYERS = {
+    'GRU':        lambda size, depth, k: GRUH0(size, size, checkpoint=k),
+    'StackedGRU': lambda size, depth, k: StackedGRUH0(size, size, depth, checkpoint=k),
+    'RHN':        lambda size, depth, k: RHN0(size, size, recur_depth=depth, checkpoint=k),
+}
+
+def bench(name, batch, length, size, depth, every):
+    k = int(round(numpy.sqrt(length))) if every < 0 else every
+    layer = LAYERS[name](size, depth, k or None)
+    x = T.tensor3()
+    value = numpy.random.uniform(-1, 1, (batch, length, size)).astype(theano.config.floatX)
+    bwd, compile_time = harness.timed(theano.function, [x], T.grad(layer(x).sum(), layer.params()))
+    return dict(layer=name, batch=batch, length=length, size=size, depth=depth, every=every, checkpoint=k,
+                compile=compile_time,
+                bwd_per_sec=harness.rate(bwd, [value], batch),
+                peak_memory=harness.peak_memory(bwd, value),
+                key=['layer', 'batch', 'length', 'size', 'depth', 'every'],
+                higher=['bwd_per_sec'],
+                lower=['compile', 'peak_memory'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gradient checkpointing of recurrent layers.')
+    parser.add_argument('--layers', type=str, default='GRU,StackedGRU,RHN', help='Comma-separated layers to run')
+    parser.add_argument('--batch',  type=harness.ints, default=[32], help='Comma-separated batch sizes')
+    parser.add_argument('--length', type=harness.ints, default=[100, 400], help='Comma-separated sequence lengths')
+    parser.add_argument('--size',   type=harness.ints, default=[256], help='Comma-separated hidden sizes')
+    parser.add_argument('--depth',  type=int, default=4, help='Depth of StackedGRU, recurrence depth of RHN')
+    parser.add_argument('--every',  type=harness.ints, default=[0, -1, 10],
+                        help='Comma-separated checkpoint intervals (0: none, -1: square root of length)')
+    parser.add_argument('--seed',   type=int, default=123, help='Random seed')
+    harness.add_arguments(parser)
+    args = parser.parse_args()
+    numpy.random.seed(args.seed)
+    results = []
+    for name in args.layers.split(','):
+        for batch in args.batch:
+            for length in args.length:
+                for size in args.size:
+                    for every in args.every:
+                        results.append(bench(name, batch, length, size, args.depth, every))
+    harness.finish(args, results)
+
+if __name__ == '__main__':
+    main()
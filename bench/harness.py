@@ -0,0 +1,116 @@
+# encoding: utf-8
+"""Helpers shared by the benchmark scripts: timing, peak memory, and
+reading, writing and comparing results.
+
+Results are stored as JSON: a dict with `meta` (environment) and `results`
+(a list of records). Records are matched against a baseline on their
+`key` fields, and the `higher` and `lower` fields are compared as
+higher-is-better and lower-is-better metrics respectively.
+"""
+from __future__ import print_function
+import sys
+import json
+import time
+import platform
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+def timed(fn, *args):
+    """Return the result of calling `fn` and the time it took."""
+    start = time.time()
+    result = fn(*args)
+    return (result, time.time() - start)
+
+def rate(fn, args, count, reps=5, min_time=0.2):
+    """Return `count` items divided by the average time of `fn(*args)`.
+    Runs `fn` once to warm up, then at least `reps` times and `min_time` seconds."""
+    fn(*args)
+    n = 0
+    start = time.time()
+    while n < reps or time.time() - start < min_time:
+        fn(*args)
+        n += 1
+    return count * n / (time.time() - start)
+
+def peak_memory(fn, *args):
+    """Return peak memory allocated while calling `fn`, in bytes, as traced
+    by tracemalloc, which also traces NumPy buffers. Returns None if
+    tracemalloc is not available (as in Python 2); the peak resident set
+    size would include everything run earlier in the process."""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def meta():
+    """Describe the environment the benchmark ran in."""
+    info = dict(python=platform.python_version(), machine=platform.machine(),
+                argv=sys.argv)
+    try:
+        import theano
+        info.update(theano=theano.__version__, floatX=theano.config.floatX,
+                    device=theano.config.device, mode=str(theano.config.mode),
+                    blas=theano.config.blas.ldflags)
+    except ImportError:
+        pass
+    return info
+
+def write(results, path=None):
+    """Write `results` with environment description to `path`, or stdout."""
+    data = json.dumps(dict(meta=meta(), results=results), indent=1, sort_keys=True)
+    if path is None:
+        print(data)
+    else:
+        with open(path, 'w') as f:
+            f.write(data)
+
+def read(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+def record_key(record):
+    return tuple(sorted((k, record[k]) for k in record['key']))
+
+def compare(results, baseline, tolerance=0.1, out=sys.stdout):
+    """Print ratios of metrics in `results` to those in `baseline`. Return
+    the number of metrics which got worse by more than `tolerance`."""
+    base = dict((record_key(r), r) for r in baseline)
+    regressions = 0
+    for r in results:
+        b = base.get(record_key(r))
+        if b is None:
+            continue
+        label = ' '.join('{}={}'.format(k, v) for k, v in record_key(r))
+        for field, better in [ (f, 1) for f in r.get('higher', []) ] + [ (f, -1) for f in r.get('lower', []) ]:
+            if not b.get(field) or r.get(field) is None:
+                continue
+            ratio = r[field] / float(b[field])
+            worse = (ratio < 1 - tolerance) if better > 0 else (ratio > 1 + tolerance)
+            regressions += worse
+            print('{:60s} {:18s} {:8.3f}{}'.format(label, field, ratio, '  REGRESSION' if worse else ''), file=out)
+    return regressions
+
+def add_arguments(parser):
+    """Add the common output and comparison options to `parser`."""
+    parser.add_argument('--output', type=str, default=None, help='Path to write results to (default: stdout)')
+    parser.add_argument('--baseline', type=str, default=None, help='Path to results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative change counted as a regression')
+
+def finish(args, results):
+    """Write results, and compare them to the baseline if one was given.
+    Exit with status 1 if there were regressions."""
+    write(results, args.output)
+    if args.baseline is not None:
+        if compare(results, read(args.baseline), tolerance=args.tolerance, out=sys.stderr) > 0:
+            sys.exit(1)
+
+def ints(s):
+    return [ int(x) for x in s.split(',') ]
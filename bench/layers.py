@@ -0,0 +1,115 @@
+# encoding: utf-8
+"""Benchmark funktional layers and the autoencoder training step.
+
+For each layer and each combination of batch size, sequence length and
+hidden size, measures compile time and throughput of the forward pass
+and of the forward+backward pass, and peak memory of one forward+backward
+pass. Run with THEANO_FLAGS set to compare Theano configurations:
+
+    python bench/layers.py --output base.json
+    THEANO_FLAGS=... python bench/layers.py --baseline base.json
+"""
+from __future__ import print_function
+import os
+import sys
+import argparse
+import numpy
+import theano
+import theano.tensor as T
+from funktional.layer import GRUH0, BidiGRUH0, StackedGRUH0, Attention, Embedding, params
+from funktional.util import softmax3d
+from funktional.rhn import RHN0
+import harness
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class Case(object):
+    """A layer applied to random input of given shape."""
+    def __init__(self, build, shape, itype='float'):
+        self.build = build
+        self.shape = shape
+        self.itype = itype
+
+    def inputs(self, batch, length, size, vocab):
+        dims = dict(batch=batch, length=length, size=size, vocab=vocab)
+        shape = [ dims[d] for d in self.shape ]
+        x = T.TensorType(theano.config.floatX, (False,) * len(shape))()
+        value = numpy.random.uniform(-1, 1, shape).astype(theano.config.floatX)
+        return (x, value)
+
+def cases(vocab):
+    seq = ('batch', 'length', 'size')
+    return {
+        'GRU':        Case(lambda size: GRUH0(size, size), seq),
+        'GRU_fused':  Case(lambda size: GRUH0(size, size, fused=True), seq),
+        'BidiGRU':    Case(lambda size: BidiGRUH0(size, size), seq),
+        'StackedGRU': Case(lambda size: StackedGRUH0(size, size, depth=2), seq),
+        'RHN1':       Case(lambda size: RHN0(size, size, recur_depth=1), seq),
+        'RHN2':       Case(lambda size: RHN0(size, size, recur_depth=2), seq),
+        'RHN4':       Case(lambda size: RHN0(size, size, recur_depth=4), seq),
+        'Attention':  Case(lambda size: Attention(size, size), seq),
+        'unembed':    Case(lambda size: Embedding(vocab, size).unembed, seq),
+        'softmax3d':  Case(lambda size: softmax3d, ('batch', 'length', 'vocab')),
+    }
+
+def bench_layer(name, case, batch, length, size, vocab):
+    layer = case.build(size)
+    x, value = case.inputs(batch, length, size, vocab)
+    out = layer(x)
+    ps = layer.params() if hasattr(layer, 'params') else []
+    wrt = ps if ps else [x]
+    fwd, compile_fwd = harness.timed(theano.function, [x], out)
+    bwd, compile_bwd = harness.timed(theano.function, [x], T.grad(out.sum(), wrt))
+    return dict(layer=name, batch=batch, length=length, size=size, vocab=vocab,
+                compile_fwd=compile_fwd, compile_bwd=compile_bwd,
+                fwd_per_sec=harness.rate(fwd, [value], batch),
+                bwd_per_sec=harness.rate(bwd, [value], batch),
+                peak_memory=harness.peak_memory(bwd, value),
+                key=['layer', 'batch', 'length', 'size', 'vocab'],
+                higher=['fwd_per_sec', 'bwd_per_sec'],
+                lower=['compile_fwd', 'compile_bwd', 'peak_memory'])
+
+def bench_model(batch, length, size, depth, vocab):
+    """Benchmark autoencoder.Model.train on random data."""
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import autoencoder
+    model, compile_time = harness.timed(autoencoder.Model, vocab, size, depth)
+    inp = numpy.random.randint(0, vocab, (batch, length)).astype('int32')
+    mask = numpy.ones((batch, length), dtype=theano.config.floatX)
+    args = [inp, inp, inp, mask, mask]
+    return dict(layer='Model.train', batch=batch, length=length, size=size, depth=depth, vocab=vocab,
+                compile=compile_time,
+                train_per_sec=harness.rate(model.train, args, batch),
+                peak_memory=harness.peak_memory(model.train, *args),
+                key=['layer', 'batch', 'length', 'size', 'depth', 'vocab'],
+                higher=['train_per_sec'],
+                lower=['compile', 'peak_memory'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark funktional layers.')
+    parser.add_argument('--layers', type=str, default=None, help='Comma-separated layers to run (default: all)')
+    parser.add_argument('--batch',  type=harness.ints, default=[16, 64], help='Comma-separated batch sizes')
+    parser.add_argument('--length', type=harness.ints, default=[20, 50], help='Comma-separated sequence lengths')
+    parser.add_argument('--size',   type=harness.ints, default=[256, 512], help='Comma-separated hidden sizes')
+    parser.add_argument('--vocab',  type=int, default=10000, help='Vocabulary size for unembed, softmax3d and Model')
+    parser.add_argument('--model',  action='store_true', help='Also benchmark autoencoder.Model.train')
+    parser.add_argument('--depth',  type=int, default=2, help='Depth of Model')
+    parser.add_argument('--seed',   type=int, default=123, help='Random seed')
+    harness.add_arguments(parser)
+    args = parser.parse_args()
+    numpy.random.seed(args.seed)
+    all_cases = cases(args.vocab)
+    names = sorted(all_cases) if args.layers is None else args.layers.split(',')
+    results = []
+    for batch in args.batch:
+        for length in args.length:
+            for size in args.size:
+                for name in names:
+                    results.append(bench_layer(name, all_cases[name], batch, length, size, args.vocab))
+                if args.model:
+                    results.append(bench_model(batch, length, size, args.depth, args.vocab))
+    harness.finish(args, results)
+
+if __name__ == '__main__':
+    main()
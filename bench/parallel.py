@@ -0,0 +1,63 @@
+# encoding: utf-8
+"""Benchmark data-parallel training of autoencoder.Model.
+
+Measures training throughput in samples per second of `Model.train` in
+one process (workers=0), and of `Model.data_parallel` with each given
+number of worker processes, on random data. `speedup` is relative to
+`Model.train`:
+
+    OMP_NUM_THREADS=1 python bench/parallel.py --workers 1,2,4,8 --batch 256
+"""
+from __future__ import print_function
+import os
+import sys
+import argparse
+import numpy
+import theano
+import harness
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def bench(model, workers, batch, length, size, depth, vocab):
+    inp = numpy.random.randint(0, vocab, (batch, length)).astype('int32')
+    mask = numpy.ones((batch, length), dtype=theano.config.floatX)
+    args = [inp, inp, inp, mask, mask]
+    if workers == 0:
+        train, compile_time = model.train, 0.0
+    else:
+        train, compile_time = harness.timed(model.data_parallel, workers)
+    try:
+        rate = harness.rate(train, args, batch)
+    finally:
+        if workers > 0:
+            train.close()
+    return dict(workers=workers, batch=batch, length=length, size=size, depth=depth, vocab=vocab,
+                compile=compile_time, samples_per_sec=rate,
+                key=['workers', 'batch', 'length', 'size', 'depth', 'vocab'],
+                higher=['samples_per_sec'],
+                lower=['compile'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark data-parallel training.')
+    parser.add_argument('--workers', type=harness.ints, default=[1, 2, 4], help='Comma-separated numbers of processes')
+    parser.add_argument('--batch',   type=int, default=128, help='Minibatch size')
+    parser.add_argument('--length',  type=int, default=20, help='Sentence length')
+    parser.add_argument('--size',    type=int, default=256, help='Size of embeddings and hidden layers')
+    parser.add_argument('--depth',   type=int, default=2, help='Number of hidden layers')
+    parser.add_argument('--vocab',   type=int, default=10000, help='Vocabulary size')
+    parser.add_argument('--seed',    type=int, default=123, help='Random seed')
+    harness.add_arguments(parser)
+    args = parser.parse_args()
+    numpy.random.seed(args.seed)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import autoencoder
+    model = autoencoder.Model(args.vocab, args.size, args.depth)
+    results = [ bench(model, workers, args.batch, args.length, args.size, args.depth, args.vocab)
+                for workers in [0] + args.workers ]
+    for r in results:
+        r['speedup'] = r['samples_per_sec'] / results[0]['samples_per_sec']
+    harness.finish(args, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# encoding: utf-8
+"""Benchmark approximate nearest-neighbour search with funktional.index.
+
+Builds an index over vectors in two halves (the second added
+incrementally), and for each number of probed lists measures query
+throughput and recall@k against the exact top k by `cosine_matrix`.
+Vectors are read from a .npy file, such as written by `autoencoder.py
+encode --stream`, or else drawn from a mixture of Gaussians:
+
+    python bench/retrieval.py --vectors encoded.npy --n_probe 1,4,16
+"""
+from __future__ import print_function
+import os
+import argparse
+import tempfile
+import numpy
+import theano
+import theano.tensor as T
+from funktional.util import cosine_matrix
+from funktional.index import write_index, top_k
+import harness
+
+def mixture(size, dim, clusters, seed):
+    rng = numpy.random.RandomState(seed)
+    centers = rng.randn(clusters, dim)
+    return centers[rng.randint(clusters, size=size)] + rng.randn(size, dim) * 0.5
+
+def exact(queries, vectors, k, batch=256):
+    """Return the ids of the `k` vectors most similar to each query, by `cosine_matrix`."""
+    U = T.matrix()
+    V = T.matrix()
+    similarity = theano.function([U, V], cosine_matrix(U, V))
+    vectors = vectors.astype(theano.config.floatX)
+    return numpy.vstack([ top_k(similarity(queries[i:i+batch].astype(theano.config.floatX), vectors), k)
+                          for i in range(0, len(queries), batch) ])
+
+def recall(found, true):
+    k = true.shape[1]
+    return numpy.mean([ len(set(f[:k]) & set(t)) / float(k) for f, t in zip(found, true) ])
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark approximate nearest-neighbour search.')
+    parser.add_argument('--vectors', type=str, default=None, help='Path to .npy file of vectors (default: random)')
+    parser.add_argument('--size',    type=int, default=100000, help='Number of random vectors')
+    parser.add_argument('--dim',     type=int, default=512, help='Dimension of random vectors')
+    parser.add_argument('--queries', type=int, default=1000, help='Number of queries, held out from the vectors')
+    parser.add_argument('--lists',   type=int, default=None, help='Number of lists (default: square root of size)')
+    parser.add_argument('--k',       type=int, default=10, help='Number of neighbours')
+    parser.add_argument('--n_probe', type=harness.ints, default=[1, 4, 16, 64], help='Comma-separated numbers of probed lists')
+    parser.add_argument('--path',    type=str, default=None, help='Directory to build the index in (default: temporary)')
+    parser.add_argument('--seed',    type=int, default=123, help='Random seed')
+    harness.add_arguments(parser)
+    args = parser.parse_args()
+    if args.vectors is None:
+        data = mixture(args.size + args.queries, args.dim, 1000, args.seed)
+    else:
+        data = numpy.load(args.vectors, mmap_mode='r')
+    queries, vectors = numpy.asarray(data[:args.queries]), numpy.asarray(data[args.queries:])
+    path = os.path.join(tempfile.mkdtemp(), 'index') if args.path is None else args.path
+    half = len(vectors) // 2
+    index, build_time = harness.timed(write_index, path, vectors[:half], None, args.lists)
+    _, add_time = harness.timed(index.add, vectors[half:])
+    true, exact_time = harness.timed(exact, queries, vectors, args.k)
+    results = [dict(method='exact', size=len(vectors), n_probe=0, k=args.k,
+                    queries_per_sec=len(queries) / exact_time, recall=1.0,
+                    key=['method', 'size', 'n_probe', 'k'], higher=['queries_per_sec', 'recall'], lower=[])]
+    for n_probe in args.n_probe:
+        (found, _), search_time = harness.timed(index.search, queries, args.k, n_probe)
+        results.append(dict(method='ivf', size=len(vectors), n_probe=n_probe, k=args.k, lists=index.meta['lists'],
+                            build=build_time, add=add_time,
+                            queries_per_sec=len(queries) / search_time,
+                            recall=recall(found, true),
+                            key=['method', 'size', 'n_probe', 'k'],
+                            higher=['queries_per_sec', 'recall'],
+                            lower=['build', 'add']))
+    harness.finish(args, results)
+
+if __name__ == '__main__':
+    main()
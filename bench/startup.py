@@ -0,0 +1,58 @@
+# encoding: utf-8
+"""Benchmark cold start: the time until a fresh Python process has
+imported funktional, or has finished an autoencoder.py command.
+
+Each command is run in a new process `--reps` times, and the minimum and
+median wall time are recorded. The encode path is timed if a trained
+model and input are given:
+
+    python bench/startup.py --model_path model/ --input sents.txt --output base.json
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import harness
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AUTOENCODER = os.path.join(ROOT, 'autoencoder.py')
+
+def cold(argv, reps):
+    """Run `argv` in `reps` fresh processes, and return the sorted wall times."""
+    times = []
+    for _ in range(reps):
+        start = time.time()
+        subprocess.check_call(argv, cwd=ROOT, stdout=open(os.devnull, 'w'))
+        times.append(time.time() - start)
+    return sorted(times)
+
+def commands(args):
+    python = [sys.executable]
+    cmds = [('python',                 python + ['-c', 'pass']),
+            ('import theano',          python + ['-c', 'import theano']),
+            ('import funktional.layer', python + ['-c', 'import funktional.layer']),
+            ('autoencoder.py --help',  python + [AUTOENCODER, '--help'])]
+    if args.model_path is not None and args.input is not None:
+        out = os.path.join(tempfile.mkdtemp(), 'encoded.pkl.gz')
+        cmds.append(('autoencoder.py encode', python + [AUTOENCODER, 'encode', args.model_path, args.input, out]))
+    return cmds
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark cold start of funktional and autoencoder.py.')
+    parser.add_argument('--reps', type=int, default=5, help='Number of runs of each command')
+    parser.add_argument('--model_path', type=str, default=None, help='Path to trained model, to time the encode command')
+    parser.add_argument('--input', type=str, default=None, help='Path to data to encode')
+    harness.add_arguments(parser)
+    args = parser.parse_args()
+    results = []
+    for name, argv in commands(args):
+        times = cold(argv, args.reps)
+        results.append(dict(command=name, min=times[0], median=times[len(times)//2],
+                            key=['command'], higher=[], lower=['min', 'median']))
+    harness.finish(args, results)
+
+if __name__ == '__main__':
+    main()
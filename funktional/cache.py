@@ -0,0 +1,145 @@
+# encoding: utf-8
+"""On-disk cache of compiled Theano functions.
+
+Groups of compiled functions are pickled under a key derived from a user-supplied
+spec of the network architecture and hyperparameters, the Theano version
+and configuration, and the structure of the symbolic graph. On a hit, the
+shared variables of the current graph are rebound to the storage of the
+stored functions, so that they read and update the parameters of the
+freshly built network:
+
+>>> cache = FunctionCache('/tmp/funktional-cache')
+>>> fns = cache.functions(spec, train=([x, y], cost, updates), predict=([x], pred))
+"""
+import os
+import sys
+import time
+import hashlib
+import pickle
+import theano
+from theano.compile.sharedvalue import SharedVariable
+
+def shared_inputs(outputs, updates=()):
+    """Return shared variables in the graph of `outputs` and `updates`, in a
+    deterministic order."""
+    exprs = list(outputs) + [ s for s, _ in updates ] + [ u for _, u in updates ]
+    return [ v for v in theano.gof.graph.inputs(exprs) if isinstance(v, SharedVariable) ]
+
+def graph_digest(outputs, updates=()):
+    """Hash of the structure of the graph of `outputs` and `updates`."""
+    exprs = list(outputs) + [ u for _, u in updates ]
+    text = theano.printing.debugprint(exprs, file='str', ids='int', print_type=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+class FunctionCache(object):
+    """Cache of compiled functions in directory `path`, holding at most
+    `max_bytes` bytes. Least recently used entries are evicted first."""
+    def __init__(self, path, max_bytes=2**30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.compile_time = 0.0
+        self.load_time = 0.0
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def stats(self):
+        """Return hit/miss counts and time spent compiling and loading."""
+        return dict(hits=self.hits, misses=self.misses,
+                    compile_time=self.compile_time, load_time=self.load_time)
+
+    def key(self, spec, fns):
+        parts = [repr(sorted(spec.items())), theano.__version__,
+                 theano.config.floatX, theano.config.device, str(theano.config.mode)]
+        for name in sorted(fns):
+            outs, updates = outputs_updates(fns[name])
+            parts += [name, graph_digest(outs, updates)]
+        return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def functions(self, spec, **fns):
+        """Compile a group of functions, reusing them from the cache if
+        a group with the same names, `spec` and graphs was stored before.
+
+        Each keyword argument maps a name to a tuple (inputs, outputs)
+        or (inputs, outputs, updates). Returns a dict from names to compiled
+        functions. Functions in a group share the storage of their shared
+        variables, so they should be compiled together.
+        """
+        shared = []
+        for name in sorted(fns):
+            for v in shared_inputs(*outputs_updates(fns[name])):
+                if v not in shared:
+                    shared.append(v)
+        path = os.path.join(self.path, self.key(spec, fns) + '.pkl')
+        compiled = self._load(path, shared)
+        if compiled is None:
+            self.misses += 1
+            start = time.time()
+            compiled = compile_functions(**fns)
+            self.compile_time += time.time() - start
+            self._store(path, compiled, shared)
+        else:
+            self.hits += 1
+        return compiled
+
+    def _load(self, path, shared):
+        start = time.time()
+        try:
+            with open(path, 'rb') as f:
+                compiled, cached = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if len(cached) != len(shared):
+            return None
+        # Make current shared variables use the storage of the cached functions
+        for old, new in zip(cached, shared):
+            old.set_value(new.get_value(borrow=True), borrow=True)
+            new.container = old.container
+        os.utime(path, None)
+        self.load_time += time.time() - start
+        return compiled
+
+    def _store(self, path, compiled, shared):
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, 50000))
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump((compiled, shared), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+        finally:
+            sys.setrecursionlimit(limit)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in `max_bytes`."""
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.pkl'):
+                p = os.path.join(self.path, name)
+                st = os.stat(p)
+                entries.append((st.st_mtime, st.st_size, p))
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(p)
+            total -= size
+
+def outputs_updates(fn):
+    outputs = fn[1] if isinstance(fn[1], (list, tuple)) else [fn[1]]
+    updates = list(fn[2]) if len(fn) > 2 else []
+    return (outputs, updates)
+
+def compile_functions(**fns):
+    """Compile a group of functions, specified as for `FunctionCache.functions`."""
+    return dict((name, theano.function(fn[0], fn[1], updates=fn[2] if len(fn) > 2 else None))
+                for name, fn in fns.items())
+
+def functions(cache, spec, **fns):
+    """Compile a group of functions, using `cache` if it is not None."""
+    if cache is None:
+        return compile_functions(**fns)
+    else:
+        return cache.functions(spec, **fns)
@@ -0,0 +1,103 @@
+# encoding: utf-8
+"""Checkpoints of parameter values, without the model objects.
+
+A checkpoint is a single uncompressed file: a magic string, an int64
+format version and header length, a JSON header, and the raw data of a
+list of named arrays, each aligned to 64 bytes. The header holds a
+user-supplied `spec` (such as the architecture and hyperparameters
+needed to rebuild the model), and the name, dtype, shape and offset of
+each array. Arrays are memory-mapped when loaded:
+
+>>> save('model.ckpt', dict(size=512), [('param.0', W), ('param.1', b)])
+>>> spec, arrays = load('model.ckpt')
+>>> layer.borrow_params([arrays['param.0'], arrays['param.1']])
+
+`AsyncSaver` writes checkpoints in a background thread.
+"""
+import os
+import json
+import struct
+import threading
+import collections
+import numpy
+
+CHECKPOINT_MAGIC = b'FUNKCKPT'
+CHECKPOINT_VERSION = 1
+ALIGN = 64
+
+def aligned(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+def save(path, spec, arrays):
+    """Write `spec` and the list of (name, array) pairs `arrays` to `path`.
+    The file is written under a temporary name and then renamed, so that
+    `path` is always a complete checkpoint."""
+    arrays = [ (name, numpy.require(a, dtype=numpy.asarray(a).dtype.newbyteorder('<'), requirements='C'))
+               for name, a in arrays ]
+    entries = []
+    offset = 0
+    for name, a in arrays:
+        entries.append(dict(name=name, dtype=a.dtype.str, shape=list(a.shape), offset=offset))
+        offset = aligned(offset + a.nbytes)
+    header = json.dumps(dict(spec=spec, arrays=entries), sort_keys=True).encode('utf-8')
+    start = aligned(len(CHECKPOINT_MAGIC) + 16 + len(header))
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(CHECKPOINT_MAGIC)
+        f.write(struct.pack('<qq', CHECKPOINT_VERSION, len(header)))
+        f.write(header)
+        for entry, (_, a) in zip(entries, arrays):
+            f.seek(start + entry['offset'])
+            f.write(a.tobytes())
+        f.truncate(start + offset)
+    os.rename(tmp, path)
+
+def load(path):
+    """Return the spec and the ordered dict of memory-mapped arrays of the checkpoint at `path`."""
+    data = numpy.memmap(path, dtype='uint8', mode='r')
+    if data[:len(CHECKPOINT_MAGIC)].tobytes() != CHECKPOINT_MAGIC:
+        raise ValueError("{} is not a checkpoint file".format(path))
+    pos = len(CHECKPOINT_MAGIC)
+    version, size = struct.unpack('<qq', data[pos:pos+16].tobytes())
+    if version > CHECKPOINT_VERSION:
+        raise ValueError("{} has checkpoint format version {}, newer than {}".format(path, version, CHECKPOINT_VERSION))
+    header = json.loads(data[pos+16:pos+16+size].tobytes().decode('utf-8'))
+    start = aligned(pos + 16 + size)
+    arrays = collections.OrderedDict()
+    for entry in header['arrays']:
+        dtype = numpy.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        begin = start + entry['offset']
+        end = begin + dtype.itemsize * int(numpy.prod(shape))
+        arrays[entry['name']] = data[begin:end].view(dtype).reshape(shape)
+    return (header['spec'], arrays)
+
+class AsyncSaver(object):
+    """Saves checkpoints in a background thread. `save` returns once the
+    arrays have been copied, after waiting for the previous save to
+    finish; an error in a save is raised by the next call of `save` or
+    `wait`."""
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, path, spec, arrays):
+        self.wait()
+        arrays = [ (name, numpy.array(a)) for name, a in arrays ]
+        self.thread = threading.Thread(target=self._run, args=(path, spec, arrays))
+        self.thread.start()
+
+    def _run(self, path, spec, arrays):
+        try:
+            save(path, spec, arrays)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """Wait for the current save to finish."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
@@ -0,0 +1,66 @@
+# encoding: utf-8
+"""Pre-tokenized, id-mapped corpora stored as flat arrays.
+
+A corpus with prefix `p` consists of two files: `p.ids`, the int32 ids of
+all tokens, and `p.offsets`, the int64 offsets such that the ids of
+sentence i are ids[offsets[i]:offsets[i+1]]. Both are memory-mapped when
+loaded, so a corpus supports random access without being read into
+memory.
+"""
+import os
+import itertools
+import numpy
+
+def write_corpus(mapper, sents, prefix, chunk_size=100000):
+    """Map `sents` to ids with `mapper`, and write them as corpus `prefix`."""
+    sents = iter(sents)
+    base = 0
+    with open(prefix + '.ids', 'wb') as f_ids, open(prefix + '.offsets', 'wb') as f_offsets:
+        f_offsets.write(numpy.zeros(1, dtype='<i8').tobytes())
+        while True:
+            chunk = list(itertools.islice(sents, chunk_size))
+            if not chunk:
+                break
+            ids, offsets = mapper.transform_flat(chunk)
+            f_ids.write(ids.astype('<i4').tobytes())
+            f_offsets.write((offsets[1:] + base).astype('<i8').tobytes())
+            base += offsets[-1]
+
+def memmap(path, dtype):
+    # Empty files cannot be mapped
+    if os.path.getsize(path) == 0:
+        return numpy.zeros(0, dtype=dtype)
+    else:
+        return numpy.memmap(path, dtype=dtype, mode='r')
+
+class Corpus(object):
+    """Memory-mapped corpus written by `write_corpus`. Indexing returns the
+    sentence as a list of ids."""
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.ids = memmap(prefix + '.ids', '<i4')
+        self.offsets = memmap(prefix + '.offsets', '<i8')
+        self.lengths = numpy.diff(self.offsets)
+
+    def __getstate__(self):
+        return dict(prefix=self.prefix)
+
+    def __setstate__(self, state):
+        self.__init__(state['prefix'])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.ids[self.offsets[i]:self.offsets[i+1]].tolist()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def lengths(sents):
+    """Return array of lengths of sentences in `sents`, which is a Corpus or a list."""
+    if isinstance(sents, Corpus):
+        return sents.lengths
+    else:
+        return numpy.array([ len(sent) for sent in sents ], dtype='int64')
@@ -0,0 +1,160 @@
+# encoding: utf-8
+"""Approximate nearest-neighbour search by cosine similarity.
+
+An index is an inverted file: vectors are normalized to unit length and
+assigned to the nearest of a set of centroids, learned by spherical
+k-means. A query is compared only to the vectors of its `n_probe` nearest
+centroids, so search time grows with the size of those lists rather than
+with the size of the index.
+
+An index is a directory holding `centroids.npy`, `index.json` and one or
+more segments. Vectors added together form a segment, with files
+`seg-N.vectors.npy` (float32 vectors sorted by list), `seg-N.ids.npy`
+(their int64 ids) and `seg-N.offsets.npy`, such that the vectors in list
+l are vectors[offsets[l]:offsets[l+1]]. Segments are memory-mapped when
+loaded, and adding vectors writes a new segment without touching the
+existing ones:
+
+>>> index = write_index('sents.index', vectors, lists=256)
+>>> index.add(more_vectors)
+>>> ids, scores = Index('sents.index').search(queries, k=10, n_probe=8)
+"""
+import os
+import json
+import numpy
+
+def normalize(X):
+    X = numpy.asarray(X, dtype='float32')
+    norm = numpy.sqrt((X ** 2).sum(axis=1, keepdims=True))
+    return X / numpy.maximum(norm, 1e-12)
+
+def kmeans(X, lists, iters=10, seed=123):
+    """Return `lists` unit-length centroids of the unit-length rows of `X`, by spherical k-means."""
+    rng = numpy.random.RandomState(seed)
+    C = X[rng.choice(len(X), size=lists, replace=len(X) < lists)]
+    for _ in range(iters):
+        assign = numpy.argmax(numpy.dot(X, C.T), axis=1)
+        sums = numpy.zeros_like(C)
+        numpy.add.at(sums, assign, X)
+        # Restart empty lists from random points
+        empty = numpy.bincount(assign, minlength=lists) == 0
+        sums[empty] = X[rng.choice(len(X), size=empty.sum())]
+        C = normalize(sums)
+    return C
+
+def top_k(scores, k):
+    """Return the column indices of the `k` largest scores in each row, best first."""
+    k = min(k, scores.shape[1])
+    best = numpy.argpartition(-scores, k-1, axis=1)[:, :k]
+    rank = numpy.arange(len(scores))[:, None]
+    return best[rank, numpy.argsort(-scores[rank, best], axis=1)]
+
+def write_index(path, vectors, ids=None, lists=None, iters=10, sample=256, seed=123):
+    """Create index at `path` with centroids learned from `vectors` (at
+    most `sample` vectors per list are used), add `vectors` to it and
+    return it. The number of lists defaults to the square root of the
+    number of vectors."""
+    X = normalize(vectors)
+    lists = int(numpy.sqrt(len(X))) if lists is None else lists
+    rng = numpy.random.RandomState(seed)
+    train = X if len(X) <= lists * sample else X[rng.choice(len(X), size=lists * sample, replace=False)]
+    if not os.path.exists(path):
+        os.makedirs(path)
+    numpy.save(os.path.join(path, 'centroids.npy'), kmeans(train, lists, iters=iters, seed=seed))
+    write_meta(path, dict(dim=X.shape[1], lists=lists, size=0, next_id=0, next_segment=0, segments=[]))
+    index = Index(path)
+    index.add(X, ids=ids)
+    return index
+
+def write_meta(path, meta):
+    tmp = os.path.join(path, 'index.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.rename(tmp, os.path.join(path, 'index.json'))
+
+class Segment(object):
+    """Memory-mapped segment of an index."""
+    def __init__(self, prefix):
+        self.vectors = numpy.load(prefix + '.vectors.npy', mmap_mode='r')
+        self.ids = numpy.load(prefix + '.ids.npy', mmap_mode='r')
+        self.offsets = numpy.load(prefix + '.offsets.npy')
+
+class Index(object):
+    """Index written by `write_index`."""
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            self.meta = json.load(f)
+        self.centroids = numpy.load(os.path.join(path, 'centroids.npy'))
+        self.segments = [ Segment(os.path.join(path, name)) for name in self.meta['segments'] ]
+
+    def __getstate__(self):
+        return dict(path=self.path)
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return self.meta['size']
+
+    def add(self, vectors, ids=None):
+        """Add `vectors` as a new segment. Ids default to consecutive
+        integers following the largest id assigned so far."""
+        X = normalize(vectors)
+        if ids is None:
+            ids = numpy.arange(self.meta['next_id'], self.meta['next_id'] + len(X))
+        ids = numpy.asarray(ids, dtype='int64')
+        assign = numpy.argmax(numpy.dot(X, self.centroids.T), axis=1)
+        order = numpy.argsort(assign, kind='mergesort')
+        offsets = numpy.zeros(self.meta['lists'] + 1, dtype='int64')
+        offsets[1:] = numpy.cumsum(numpy.bincount(assign, minlength=self.meta['lists']))
+        name = 'seg-{}'.format(self.meta['next_segment'])
+        prefix = os.path.join(self.path, name)
+        numpy.save(prefix + '.vectors.npy', X[order])
+        numpy.save(prefix + '.ids.npy', ids[order])
+        numpy.save(prefix + '.offsets.npy', offsets)
+        self.meta['segments'].append(name)
+        self.meta['next_segment'] += 1
+        self.meta['size'] += len(X)
+        self.meta['next_id'] = max(self.meta['next_id'], int(ids.max()) + 1 if len(ids) > 0 else 0)
+        write_meta(self.path, self.meta)
+        self.segments.append(Segment(prefix))
+
+    def search(self, queries, k=10, n_probe=8):
+        """Return the ids of the (approximately) `k` vectors most similar to
+        each of `queries`, and their cosine similarities, best first.
+        Queries with fewer than `k` candidates are padded with id -1."""
+        Q = normalize(queries)
+        probe = top_k(numpy.dot(Q, self.centroids.T), n_probe)
+        best_ids = numpy.empty((len(Q), k), dtype='int64')
+        best_ids.fill(-1)
+        best_scores = numpy.empty((len(Q), k), dtype='float32')
+        best_scores.fill(-numpy.inf)
+        # Score all queries probing a list against it at once
+        for l in numpy.unique(probe):
+            rows = numpy.nonzero((probe == l).any(axis=1))[0]
+            for seg in self.segments:
+                start, end = seg.offsets[l], seg.offsets[l+1]
+                if start == end:
+                    continue
+                scores = numpy.hstack([best_scores[rows], numpy.dot(Q[rows], seg.vectors[start:end].T)])
+                ids = numpy.hstack([best_ids[rows], numpy.broadcast_to(seg.ids[start:end], (len(rows), end-start))])
+                best = top_k(scores, k)
+                rank = numpy.arange(len(rows))[:, None]
+                best_scores[rows] = scores[rank, best]
+                best_ids[rows] = ids[rank, best]
+        return (best_ids, best_scores)
+
+    def merge(self):
+        """Rewrite all segments as a single segment."""
+        if len(self.segments) <= 1:
+            return
+        vectors = numpy.vstack([ seg.vectors for seg in self.segments ])
+        ids = numpy.hstack([ seg.ids for seg in self.segments ])
+        names = self.meta['segments']
+        self.segments = []
+        self.meta.update(size=0, segments=[])
+        self.add(vectors, ids=ids)
+        for name in names:
+            for ext in ['.vectors.npy', '.ids.npy', '.offsets.npy']:
+                os.remove(os.path.join(self.path, name + ext))
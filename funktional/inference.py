@@ -0,0 +1,303 @@
+# encoding: utf-8
+"""Forward pass of trained funktional networks in pure NumPy.
+
+Layers are converted with `convert`, which copies parameter values out
+of the layer's `params()`. The converted objects do not depend on Theano,
+and can be pickled and used for inference in processes which never
+import it:
+
+>>> net = convert(trained_layer)
+>>> H = net(inp)
+
+`save` writes converted layers to a file, and `load` reads them back
+without importing Theano:
+
+>>> save(net, 'net.pkl')
+>>> net = load('net.pkl')
+"""
+import pickle
+import numpy
+
+def linear(x):
+    return x
+
+def tanh(x):
+    return numpy.tanh(x)
+
+def rectify(x):
+    return numpy.maximum(x, 0.0)
+
+def clipped_rectify(x):
+    return numpy.clip(x, 0.0, 5.0)
+
+def elu(x):
+    return numpy.where(x > 0.0, x, numpy.expm1(numpy.minimum(x, 0.0)))
+
+def clipped_elu(x):
+    return numpy.clip(elu(x), -1.0, 5.0)
+
+def sigmoid(x):
+    return 1./(1. + numpy.exp(-x))
+
+def steeper_sigmoid(x):
+    return 1./(1. + numpy.exp(-3.75 * x))
+
+ACTIVATIONS = dict((f.__name__, f) for f in [linear, tanh, rectify, clipped_rectify, elu,
+                                              clipped_elu, sigmoid, steeper_sigmoid])
+
+def activation(f):
+    """Return the NumPy version of activation function `f`."""
+    try:
+        return ACTIVATIONS[f.__name__]
+    except KeyError:
+        raise ValueError("No NumPy version of activation {}".format(f.__name__))
+
+def softmax(x):
+    e_x = numpy.exp(x - x.max(axis=-1, keepdims=True))
+    return e_x / e_x.sum(axis=-1, keepdims=True)
+
+def softmax3d(inp):
+    return softmax(inp)
+
+def softmax_time(x):
+    """Input has shape Batch x Time x 1. Return softmax over dimension T."""
+    return softmax(x[:,:,0])[:,:,None]
+
+def last(x):
+    """Returns the last time step of all sequences in x."""
+    return x[:,-1]
+
+def first(x):
+    """Returns the first time step of all sequences in x."""
+    return x[:,0]
+
+def values(layer):
+    return [ p.get_value() for p in layer.params() ]
+
+
+class Layer(object):
+    """NumPy counterpart of funktional.layer.Layer."""
+    def __call__(self, *inp):
+        raise NotImplementedError
+
+    def compose(self, l2):
+        return ComposedLayer(self, l2)
+
+class Identity(Layer):
+    def __call__(self, inp, mask=None):
+        return inp
+
+class Residual(Layer):
+    def __init__(self, layer):
+        self.layer = layer
+
+    def __call__(self, inp, mask=None):
+        return inp + self.layer(inp, mask=mask)
+
+class ComposedLayer(Layer):
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+
+    def __call__(self, inp, mask=None):
+        return self.first(self.second(inp, mask=mask), mask=mask)
+
+class Embedding(Layer):
+    def __init__(self, E):
+        self.E = E
+
+    def __call__(self, inp):
+        return self.E[inp]
+
+    def unembed(self, inp):
+        return numpy.dot(inp, self.E.T)
+
+class Dense(Layer):
+    def __init__(self, w, b):
+        self.w = w
+        self.b = b
+
+    def __call__(self, inp):
+        return numpy.dot(inp, self.w) + self.b
+
+class Zeros(Layer):
+    def __init__(self, zeros):
+        self.zeros = zeros
+
+    def __call__(self):
+        return self.zeros
+
+def initial_state(h0, batch_size, repeat_h0):
+    return numpy.repeat(h0, batch_size, axis=0) if repeat_h0 else h0
+
+def recur(step, h0, xs, mask=None, backward=False):
+    """Run `step` over the time steps of time-major sequence `xs`, returning
+    states in the order they were computed, like `theano.scan`."""
+    steps = range(len(xs)-1, -1, -1) if backward else range(len(xs))
+    h = h0
+    out = []
+    for t in steps:
+        h_t = step(xs[t], h)
+        h = h_t if mask is None else mask[t] * h_t + (1 - mask[t]) * h
+        out.append(h)
+    return numpy.stack(out, axis=1)
+
+class GRU(Layer):
+    """GRU with parameters in the fused layout."""
+    def __init__(self, w, u_zr, u_h, b, activation=tanh, gate_activation=steeper_sigmoid, backward=False):
+        self.w = w
+        self.u_zr = u_zr
+        self.u_h = u_h
+        self.b = b
+        self.size = u_h.shape[0]
+        self.activation = activation
+        self.gate_activation = gate_activation
+        self.backward = backward
+
+    def step(self, x_t, h_tm1):
+        zr = self.gate_activation(x_t[:, :2*self.size] + numpy.dot(h_tm1, self.u_zr))
+        z = zr[:, :self.size]
+        r = zr[:, self.size:]
+        h_tilda_t = self.activation(x_t[:, 2*self.size:] + numpy.dot(r * h_tm1, self.u_h))
+        return (1 - z) * h_tm1 + z * h_tilda_t
+
+    def __call__(self, h0, seq, repeat_h0=1, mask=None):
+        X = seq.transpose((1,0,2))
+        x = numpy.dot(X, self.w) + self.b
+        M = None if mask is None else mask.T[:,:,None]
+        return recur(self.step, initial_state(h0, seq.shape[0], repeat_h0), x, mask=M, backward=self.backward)
+
+class BidiGRU(Layer):
+    def __init__(self, gru_f, gru_b):
+        self.gru_f = gru_f
+        self.gru_b = gru_b
+
+    def __call__(self, h0, seq, repeat_h0=1, mask=None):
+        H_f, H_b = self.bidi(h0, seq, repeat_h0=repeat_h0, mask=mask)
+        return H_f + H_b
+
+    def bidi(self, h0, seq, repeat_h0=1, mask=None):
+        return (self.gru_f(h0, seq, repeat_h0=repeat_h0, mask=mask),
+                self.gru_b(h0, seq, repeat_h0=repeat_h0, mask=mask))
+
+class WithH0(Layer):
+    def __init__(self, h0, layer):
+        self.h0 = h0
+        self.layer = layer
+
+    def __call__(self, inp, mask=None):
+        return self.layer(self.h0(), inp, repeat_h0=1, mask=mask)
+
+    def bidi(self, inp, mask=None):
+        return self.layer.bidi(self.h0(), inp, repeat_h0=1, mask=mask)
+
+class StackedGRU(Layer):
+    def __init__(self, bottom, stack):
+        self.bottom = bottom
+        self.stack = stack
+
+    def __call__(self, h0, inp, repeat_h0=0, mask=None):
+        return self.stack(self.bottom(h0, inp, repeat_h0=repeat_h0, mask=mask), mask=mask)
+
+class RHN(Layer):
+    """Recurrent Highway Network, without dropout."""
+    def __init__(self, LinearH, LinearT, recurH, recurT):
+        self.LinearH = LinearH
+        self.LinearT = LinearT
+        self.recurH = recurH
+        self.recurT = recurT
+
+    def step(self, i_t, h_tm1):
+        i_for_H_t, i_for_T_t = i_t
+        s_lm1 = h_tm1
+        for l in range(len(self.recurH)):
+            if l == 0:
+                H = tanh(i_for_H_t + self.recurH[l](s_lm1))
+                T = sigmoid(i_for_T_t + self.recurT[l](s_lm1))
+            else:
+                H = tanh(self.recurH[l](s_lm1))
+                T = sigmoid(self.recurT[l](s_lm1))
+            s_lm1 = (H - s_lm1) * T + s_lm1
+        return s_lm1
+
+    def __call__(self, h0, seq, repeat_h0=1, mask=None):
+        inputs = seq.transpose((1,0,2))
+        i = list(zip(self.LinearH(inputs), self.LinearT(inputs)))
+        M = None if mask is None else mask.T[:,:,None]
+        return recur(self.step, initial_state(h0, seq.shape[0], repeat_h0), i, mask=M)
+
+class Attention(Layer):
+    def __init__(self, Regress1, Regress2, activation=tanh):
+        self.Regress1 = Regress1
+        self.Regress2 = Regress2
+        self.activation = activation
+
+    def __call__(self, h):
+        alpha = softmax_time(self.Regress2(self.activation(self.Regress1(h))))
+        return numpy.sum(alpha * h, axis=1)
+
+class EncoderDecoderGRU(Layer):
+    def __init__(self, Encode, Decode):
+        self.Encode = Encode
+        self.Decode = Decode
+
+    def __call__(self, inp, out_prev, mask_inp=None, mask_out=None):
+        return self.Decode(last(self.Encode(inp, mask=mask_inp)), out_prev, mask=mask_out)
+
+
+def convert_gru(layer):
+    if layer.fused:
+        ps = values(layer)
+    else:
+        from funktional.layer import merge_gru_params
+        ps = merge_gru_params(values(layer))
+    return GRU(*ps, activation=activation(layer.activation),
+               gate_activation=activation(layer.gate_activation),
+               backward=layer.backward)
+
+def convert_linear(layer):
+    ps = values(layer)
+    return Dense(ps[0], ps[1] if len(ps) > 1 else 0.0)
+
+CONVERTERS = {
+    'Identity':             lambda l: Identity(),
+    'Dropout':              lambda l: Identity(),
+    'Residual':             lambda l: Residual(convert(l.layer)),
+    'ComposedLayer':        lambda l: ComposedLayer(convert(l.first), convert(l.second)),
+    'Embedding':            lambda l: Embedding(*values(l)),
+    'Dense':                lambda l: Dense(*values(l)),
+    'Linear':               convert_linear,
+    'Zeros':                lambda l: Zeros(*values(l)),
+    'FixedZeros':           lambda l: Zeros(numpy.zeros((1, l.size))),
+    'GRU_gate_activations': convert_gru,
+    'GRU':                  lambda l: convert(l.gru),
+    'BidiGRU':              lambda l: BidiGRU(convert(l.gru_f), convert(l.gru_b)),
+    'WithH0':               lambda l: WithH0(convert(l.h0), convert(l.layer)),
+    'StackedGRU':           lambda l: StackedGRU(convert(l.bottom), convert(l.stack)),
+    'StackedRHN':           lambda l: StackedGRU(convert(l.bottom), convert(l.stack)),
+    'RHN':                  lambda l: RHN(convert(l.LinearH), convert(l.LinearT),
+                                          [ convert(r) for r in l.recurH ],
+                                          [ convert(r) for r in l.recurT ]),
+    'Attention':            lambda l: Attention(convert(l.Regress1), convert(l.Regress2),
+                                                activation=activation(l.activation)),
+    'EncoderDecoderGRU':    lambda l: EncoderDecoderGRU(convert(l.Encode), convert(l.Decode)),
+}
+
+def convert(layer):
+    """Return a NumPy copy of trained `layer` for inference."""
+    name = type(layer).__name__
+    try:
+        converter = CONVERTERS[name]
+    except KeyError:
+        raise ValueError("No NumPy version of layer {}".format(name))
+    return converter(layer)
+
+def save(net, path):
+    """Pickle converted layer `net` (or a structure of them) to `path`."""
+    with open(path, 'wb') as f:
+        pickle.dump(net, f, protocol=2)
+
+def load(path):
+    """Load converted layers saved by `save`."""
+    with open(path, 'rb') as f:
+        return pickle.load(f)
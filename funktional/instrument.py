@@ -0,0 +1,186 @@
+# encoding: utf-8
+"""Per-layer profiling of funktional networks.
+
+While `recording` is active, every call of a `Layer` is recorded with its
+symbolic inputs and outputs, under a name derived from the attribute path
+from a root layer (e.g. `net.Encdec.Encode`). `profile` then compiles the
+subgraph of each recorded call separately, runs it under Theano's
+profiler on the intermediate values computed from given inputs, and
+reports its op time together with parameter and FLOP estimates:
+
+>>> rec = Recorder(net=network)
+>>> with recording(rec):
+...     out = network(x)
+>>> stats = profile(rec, [x], [x_value])
+>>> print(table(stats))
+>>> open('net.folded', 'w').write(folded(stats))
+
+The times are inclusive of layers called inside a layer; `self_time`
+excludes them. Since subgraphs are compiled separately, optimizations
+across layer boundaries are not reflected. Layers called inside a scan
+step (such as the Linear layers of RHN) cannot be compiled on their own,
+and are counted only in the time of the layer running the scan.
+"""
+import contextlib
+import functools
+import numpy
+import theano
+from theano.compile.profiling import ProfileStats
+from theano.compile.sharedvalue import SharedVariable
+from funktional.layer import Layer, param_count
+
+def subclasses(cls):
+    result = []
+    for sub in cls.__subclasses__():
+        result.append(sub)
+        result.extend(subclasses(sub))
+    return result
+
+def layer_names(roots):
+    """Map ids of layers reachable from `roots` (a dict from names to layers)
+    to their attribute paths, preferring the shortest."""
+    names = {}
+    queue = sorted(roots.items())
+    while queue:
+        name, layer = queue.pop(0)
+        if id(layer) in names:
+            continue
+        names[id(layer)] = name
+        for attr, value in sorted(vars(layer).items()):
+            if isinstance(value, Layer):
+                queue.append(('{}.{}'.format(name, attr), value))
+            elif isinstance(value, (list, tuple)):
+                for i, v in enumerate(value):
+                    if isinstance(v, Layer):
+                        queue.append(('{}.{}[{}]'.format(name, attr, i), v))
+    return names
+
+def variables(xs):
+    """Non-shared, non-constant Theano variables in `xs`."""
+    return [ x for x in xs if isinstance(x, theano.Variable)
+             and not isinstance(x, (SharedVariable, theano.Constant)) ]
+
+class Call(object):
+    """A recorded call of a layer."""
+    def __init__(self, name, path, parent, layer, inputs):
+        self.name = name
+        self.path = path
+        self.parent = parent
+        self.layer = layer
+        self.inputs = inputs
+        self.outputs = None
+
+class Recorder(object):
+    """Records layer calls. Layers are named after their attribute paths
+    from the `roots` given as keyword arguments."""
+    def __init__(self, **roots):
+        self.names = layer_names(roots)
+        self.calls = []
+        self.stack = []
+
+    def name(self, layer):
+        return self.names.get(id(layer), type(layer).__name__)
+
+    def enter(self, layer, args):
+        name = self.name(layer)
+        parent = self.stack[-1] if self.stack else None
+        path = (parent.path if parent else ()) + (name.split('.')[-1],)
+        call = Call(name, path, parent, layer, variables(args))
+        self.calls.append(call)
+        self.stack.append(call)
+        return call
+
+    def exit(self, call, outputs):
+        outputs = list(outputs) if isinstance(outputs, (list, tuple)) else [outputs]
+        # Some layers return None in place of outputs they do not compute
+        call.outputs = [ o for o in outputs if isinstance(o, theano.Variable) ]
+        self.stack.pop()
+
+def wrap(call, recorder):
+    @functools.wraps(call)
+    def wrapper(self, *args, **kwargs):
+        c = recorder.enter(self, list(args) + list(kwargs.values()))
+        try:
+            out = call(self, *args, **kwargs)
+        except:
+            recorder.stack.pop()
+            raise
+        recorder.exit(c, out)
+        return out
+    return wrapper
+
+@contextlib.contextmanager
+def recording(recorder):
+    """Record calls of all layers in `recorder` within the `with` block."""
+    patched = []
+    for cls in [Layer] + subclasses(Layer):
+        if '__call__' in cls.__dict__:
+            patched.append((cls, cls.__dict__['__call__']))
+            cls.__call__ = wrap(cls.__dict__['__call__'], recorder)
+    try:
+        yield recorder
+    finally:
+        for cls, call in patched:
+            cls.__call__ = call
+
+def computable(xs, inputs):
+    """Whether `xs` depend on no variables other than `inputs`, which is not
+    the case for the variables of a scan step."""
+    return all(v in inputs for v in variables(theano.gof.graph.inputs(xs)))
+
+def profile(recorder, inputs, values, reps=10):
+    """Time the recorded calls, given `values` for the symbolic `inputs` of
+    the whole network. Returns a list of dicts, one for each call which
+    can be computed from `inputs`."""
+    env = dict(zip(inputs, values))
+    calls = [ call for call in recorder.calls if call.outputs and computable(call.inputs, inputs) ]
+    needed = []
+    for call in calls:
+        for v in call.inputs:
+            if v not in env and v not in needed:
+                needed.append(v)
+    if needed:
+        intermediate = theano.function(inputs, needed, on_unused_input='ignore')
+        env.update(zip(needed, intermediate(*values)))
+    times = {}
+    stats = []
+    for call in calls:
+        prof = ProfileStats(atexit_print=False)
+        fn = theano.function(call.inputs, call.outputs, profile=prof, on_unused_input='ignore')
+        args = [ env[v] for v in call.inputs ]
+        for _ in range(reps):
+            fn(*args)
+        times[id(call)] = sum(prof.apply_time.values()) / reps
+        ps = call.layer.params()
+        tokens = int(numpy.prod(numpy.shape(args[0])[:-1])) if args else 1
+        stats.append(dict(name=call.name, path=call.path, call=call,
+                          params=param_count(ps) if ps else 0,
+                          param_bytes=sum(p.get_value(borrow=True).nbytes for p in ps),
+                          # Each parameter takes part in one multiply-add per token
+                          flops=2 * (param_count(ps) if ps else 0) * tokens))
+    for s in stats:
+        call = s.pop('call')
+        children = [ c for c in calls if c.parent is call ]
+        s['time'] = times[id(call)]
+        s['self_time'] = max(0.0, s['time'] - sum(times[id(c)] for c in children))
+    return stats
+
+def table(stats):
+    """Format `stats` as a table, with layers indented by nesting depth."""
+    total = sum(s['self_time'] for s in stats) or 1.0
+    lines = ['{:50s} {:>10s} {:>10s} {:>6s} {:>10s} {:>10s} {:>10s}'.format(
+        'layer', 'time ms', 'self ms', 'self%', 'params', 'param MB', 'MFLOP')]
+    for s in stats:
+        lines.append('{:50s} {:10.3f} {:10.3f} {:6.1f} {:10d} {:10.3f} {:10.1f}'.format(
+            '  ' * (len(s['path'])-1) + s['name'], s['time'] * 1000, s['self_time'] * 1000,
+            100 * s['self_time'] / total, s['params'], s['param_bytes'] / 2.0**20, s['flops'] / 1e6))
+    return '\n'.join(lines)
+
+def folded(stats):
+    """Format `stats` as folded stacks with self time in microseconds, as
+    read by flamegraph.pl and compatible viewers."""
+    totals = {}
+    for s in stats:
+        key = ';'.join(s['path'])
+        totals[key] = totals.get(key, 0) + s['self_time']
+    return ''.join('{} {}\n'.format(k, int(round(v * 1e6))) for k, v in sorted(totals.items()))
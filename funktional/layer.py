@@ -6,14 +6,28 @@
 import theano
 import theano.tensor as T
 from funktional.util import *
-import funktional.context
+import funktional.context as context
 import numpy
-from theano.sandbox.rng_mrg import MRG_RandomStreams
 from functools import reduce
 
 def params(*layers):
     return sum([ layer.params() for layer in layers ], [])
 
+def param_span(ps, *layers):
+    """Return the number of leading values of `ps` which are parameters of `layers`."""
+    n = 0
+    for layer in layers:
+        n += layer.param_span(ps[n:])
+    return n
+
+def borrow_params(ps, *layers):
+    """Overwrite parameters of `layers` with given values, in the order of `params`."""
+    for layer in layers:
+        n = layer.param_span(ps)
+        layer.borrow_params(ps[:n])
+        ps = ps[n:]
+    assert len(ps) == 0
+
 def param_count(ps):
     return sum(reduce(lambda x, z: x*z, p.get_value().shape) for p in ps)
 
@@ -32,6 +46,17 @@ class Layer(object):
         """Compose itself with another layer."""
         return ComposedLayer(self, l2)
 
+    def stream(self, x_t, states):
+        """Apply layer to a single time step `x_t`, given the list of
+        recurrent states after the previous step. Return the output and the
+        list of new states. Layers without recurrent state are applied to
+        the time step directly."""
+        return (self(x_t), [])
+
+    def stream_init(self, batch_size, h0=None):
+        """Return list of initial recurrent states for `stream`."""
+        return []
+
     def borrow_params(self, ps):
         """Overwrite parameters with given values."""
         qs = self.params()
@@ -40,9 +65,15 @@ class Layer(object):
             print("Setting value of {}".format(q))
             q.set_value(p)
 
+    def param_span(self, ps):
+        """Return the number of leading values of `ps` which are parameters
+        of this layer. This differs from the number of its parameters if
+        the values are in another layout, such as the fused one of GRU."""
+        return len(self.params())
+
 class Identity(Layer):
     """Return the input unmodified."""
-    def __call__(self, inp):
+    def __call__(self, inp, mask=None):
         return inp
 
     def params(self):
@@ -53,12 +84,28 @@ class Residual(Layer):
     def __init__(self, layer):
         autoassign(locals())
 
-    def __call__(self, inp):
-        return inp + self.layer(inp)
+    def __call__(self, inp, mask=None):
+        if mask is None:
+            return inp + self.layer(inp)
+        else:
+            return inp + self.layer(inp, mask=mask)
+
+    def stream(self, x_t, states):
+        y_t, states = self.layer.stream(x_t, states)
+        return (x_t + y_t, states)
+
+    def stream_init(self, batch_size, h0=None):
+        return self.layer.stream_init(batch_size)
 
     def params(self):
         return self.layer.params()
 
+    def borrow_params(self, ps):
+        self.layer.borrow_params(ps)
+
+    def param_span(self, ps):
+        return self.layer.param_span(ps)
+
 class ComposedLayer(Layer):
 
     def __init__(self, first, second):
@@ -67,14 +114,32 @@ class ComposedLayer(Layer):
     def params(self):
         return params(self.first, self.second)
 
-    def __call__(self, inp):
-        return self.first(self.second(inp))
+    def borrow_params(self, ps):
+        borrow_params(ps, self.first, self.second)
+
+    def param_span(self, ps):
+        return param_span(ps, self.first, self.second)
+
+    def __call__(self, inp, mask=None):
+        if mask is None:
+            return self.first(self.second(inp))
+        else:
+            return self.first(self.second(inp, mask=mask), mask=mask)
 
     def intermediate(self, inp):
         x = self.second(inp)
         z = self.first(x)
         return (x,z)
 
+    def stream(self, x_t, states):
+        n = len(self.second.stream_init(1))
+        x_t, states_second = self.second.stream(x_t, states[:n])
+        y_t, states_first = self.first.stream(x_t, states[n:])
+        return (y_t, states_second + states_first)
+
+    def stream_init(self, batch_size, h0=None):
+        return self.second.stream_init(batch_size) + self.first.stream_init(batch_size)
+
 class Embedding(Layer):
     """Embedding (lookup table) layer."""
     def __init__(self, size_in, size_out):
@@ -126,12 +191,13 @@ class Dropout(Layer):
     """Randomly set `prob` fraction of input units to zero during training."""
     def __init__(self, prob):
         autoassign(locals())
+        from theano.sandbox.rng_mrg import MRG_RandomStreams
         self.rstream = MRG_RandomStreams(seed=numpy.random.randint(10e6))
 
     def params(self):
         return []
 
-    def __call__(self, inp):
+    def __call__(self, inp, mask=None):
         if self.prob > 0.0:
             keep = 1.0 - self.prob
             if context.training:
@@ -161,19 +227,97 @@ class Sum(Layer):
         return out.dimshuffle((1,0,2)) # return the whole sequence of partial sums
                                        # to be compatible with recurrent layers
 
+def merge_gru_params(ps):
+    """Convert GRU parameter values from the unfused to the fused layout."""
+    w_z, w_r, w_h, u_z, u_r, u_h, b_z, b_r, b_h = ps
+    return [numpy.concatenate([w_z, w_r, w_h], axis=1),
+            numpy.concatenate([u_z, u_r], axis=1),
+            u_h,
+            numpy.concatenate([b_z, b_r, b_h])]
+
+def split_gru_params(ps):
+    """Convert GRU parameter values from the fused to the unfused layout."""
+    w, u_zr, u_h, b = ps
+    w_z, w_r, w_h = numpy.split(w, 3, axis=1)
+    u_z, u_r = numpy.split(u_zr, 2, axis=1)
+    b_z, b_r, b_h = numpy.split(b, 3)
+    return [w_z, w_r, w_h, u_z, u_r, u_h, b_z, b_r, b_h]
+
+def initial_state(size, batch_size, h0=None):
+    """Initial state for `batch_size` sequences: `h0` repeated, or zeros."""
+    if h0 is None:
+        return T.zeros((batch_size, size))
+    else:
+        return T.repeat(h0, batch_size, axis=0)
+
+def segments(x, every):
+    """Pad sequence `x` (time first) with zeros to a multiple of `every`
+    steps, and split it into segments of shape n x every x ..."""
+    n = (x.shape[0] + every - 1) // every
+    rest = [ x.shape[i] for i in range(1, x.ndim) ]
+    padding = T.zeros([n * every - x.shape[0]] + rest, dtype=x.dtype)
+    return T.concatenate([x, padding]).reshape([n, every] + rest, ndim=x.ndim+1)
+
+def checkpoint_scan(step, prepare, sequences, h0, non_sequences, every):
+    """Like theano.scan of `step` with a single recurrent output with
+    initial value `h0`, but keeping for the backward pass only the
+    outputs and the state at the end of each segment of `every` steps.
+
+    The sequences passed to `step` are computed by `prepare` from each
+    segment of `sequences` (time first), so they are recomputed in the
+    backward pass together with the intermediate results of `step`.
+    """
+    n = len(sequences)
+    def segment(*args):
+        out, _ = theano.scan(step, sequences=prepare(*args[:n]), outputs_info=[args[n]],
+                             non_sequences=list(args[n+1:]))
+        return out, out[-1]
+    (out, _), _ = theano.scan(segment, sequences=[ segments(x, every) for x in sequences ],
+                              outputs_info=[None, h0], non_sequences=non_sequences)
+    return out.reshape([-1] + [ out.shape[i] for i in range(2, out.ndim) ], ndim=out.ndim-1)[:sequences[0].shape[0]]
+
 class GRU_gate_activations(Layer):
     """Gated Recurrent Unit layer. Takes initial hidden state, and a
        sequence of inputs, and returns the sequence of hidden states,
        and the sequences of gate activations.
+
+       If `fused` is True, the input weights of the three gates are stored
+       as one (size_in, 3*size) matrix, and the recurrent weights of the
+       update and reset gates as one (size, 2*size) matrix, so that each
+       timestep needs two matrix products instead of three.
+
+       If `checkpoint` is an integer k, the sequence is processed in
+       segments of k steps. The hidden states of all steps are kept for
+       backpropagation, but the input projections and gate activations
+       are not: they are recomputed segment by segment in the backward
+       pass, so only those of one segment are held at a time. Gate
+       activations are then not returned.
     """
     def __init__(self, size_in, size, activation=tanh, gate_activation=steeper_sigmoid,
                  init_in=orthogonal, init_recur=orthogonal,
-                 identity=False, backward=False):
+                 identity=False, backward=False, fused=False, checkpoint=None):
         autoassign(locals())
         if self.identity:
             self._init_identity()
         else:
             self._init()
+        if self.fused:
+            self._fuse()
+
+    def __setstate__(self, state):
+        # Models pickled before the fused layout was introduced
+        state.setdefault('fused', False)
+        state.setdefault('checkpoint', None)
+        # Fused layers used to keep a stale copy of w_h
+        if state['fused']:
+            state.pop('w_h', None)
+        self.__dict__.update(state)
+
+    def _fuse(self):
+        """Replace separate gate parameters with concatenated ones."""
+        self.w, self.u_zr, self.u_h, self.b = \
+            [ sharedX(p) for p in merge_gru_params([ q.get_value() for q in self._unfused_params() ]) ]
+        del self.w_z, self.w_r, self.w_h, self.u_z, self.u_r, self.b_z, self.b_r, self.b_h
 
     def _init_identity(self, prob=0.9):
         """Initialize layer as identity function."""
@@ -207,9 +351,28 @@ class GRU_gate_activations(Layer):
         self.b_h = shared0s((self.size))
 
 
-    def params(self):
+    def _unfused_params(self):
         return [self.w_z, self.w_r, self.w_h, self.u_z, self.u_r, self.u_h, self.b_z, self.b_r, self.b_h]
 
+    def params(self):
+        if self.fused:
+            return [self.w, self.u_zr, self.u_h, self.b]
+        else:
+            return self._unfused_params()
+
+    def borrow_params(self, ps):
+        """Overwrite parameters with given values, converting them
+        from the fused to the unfused layout or vice versa if needed."""
+        if self.fused and len(ps) == 9:
+            ps = merge_gru_params(ps)
+        elif not self.fused and len(ps) == 4:
+            ps = split_gru_params(ps)
+        Layer.borrow_params(self, ps)
+
+    def param_span(self, ps):
+        # The first parameter is the input weight matrix of all three gates in the fused layout
+        return 4 if numpy.shape(ps[0])[1] == 3 * self.size else 9
+
     def step(self, xz_t, xr_t, xh_t, h_tm1, u_z, u_r, u_h):
         z = self.gate_activation(xz_t + T.dot(h_tm1, u_z))
         r = self.gate_activation(xr_t + T.dot(h_tm1, u_r))
@@ -217,20 +380,92 @@ class GRU_gate_activations(Layer):
         h_t = (1 - z) * h_tm1 + z * h_tilda_t
         return h_t, r, z
 
-    def __call__(self, h0, seq, repeat_h0=0):
+    def step_mask(self, xz_t, xr_t, xh_t, m_t, h_tm1, u_z, u_r, u_h):
+        """Like `step`, but keeps the previous state where `m_t` is zero."""
+        h_t, r, z = self.step(xz_t, xr_t, xh_t, h_tm1, u_z, u_r, u_h)
+        return m_t * h_t + (1 - m_t) * h_tm1, r, z
+
+    def step_fused(self, x_t, h_tm1, u_zr, u_h):
+        zr = self.gate_activation(x_t[:, :2*self.size] + T.dot(h_tm1, u_zr))
+        z = zr[:, :self.size]
+        r = zr[:, self.size:]
+        h_tilda_t = self.activation(x_t[:, 2*self.size:] + T.dot(r * h_tm1, u_h))
+        h_t = (1 - z) * h_tm1 + z * h_tilda_t
+        return h_t, r, z
+
+    def step_fused_mask(self, x_t, m_t, h_tm1, u_zr, u_h):
+        """Like `step_fused`, but keeps the previous state where `m_t` is zero."""
+        h_t, r, z = self.step_fused(x_t, h_tm1, u_zr, u_h)
+        return m_t * h_t + (1 - m_t) * h_tm1, r, z
+
+    def __call__(self, h0, seq, repeat_h0=0, mask=None):
+        if self.checkpoint:
+            return self._call_checkpoint(h0, seq, repeat_h0=repeat_h0, mask=mask)
+        if self.fused:
+            return self._call_fused(h0, seq, repeat_h0=repeat_h0, mask=mask)
         X = seq.dimshuffle((1,0,2))
         H0 = T.repeat(h0, X.shape[1], axis=0) if repeat_h0 else h0
         x_z = T.dot(X, self.w_z) + self.b_z
         x_r = T.dot(X, self.w_r) + self.b_r
         x_h = T.dot(X, self.w_h) + self.b_h
-        out, _ = theano.scan(self.step,
-            sequences=[x_z, x_r, x_h],
+        if mask is None:
+            step, sequences = self.step, [x_z, x_r, x_h]
+        else:
+            step, sequences = self.step_mask, [x_z, x_r, x_h, mask.dimshuffle((1,0,'x'))]
+        out, _ = theano.scan(step,
+            sequences=sequences,
                              outputs_info=[H0, None, None],
                              non_sequences=[self.u_z, self.u_r, self.u_h],
                              go_backwards=self.backward
         )
         return (out[0].dimshuffle((1,0,2)), out[1].dimshuffle((1,0,2)), out[2].dimshuffle((1,0,2)))
 
+    def _call_checkpoint(self, h0, seq, repeat_h0=0, mask=None):
+        X = seq.dimshuffle((1,0,2))
+        H0 = T.repeat(h0, X.shape[1], axis=0) if repeat_h0 else h0
+        sequences = [X] if mask is None else [X, mask.dimshuffle((1,0,'x'))]
+        if self.backward:
+            sequences = [ x[::-1] for x in sequences ]
+        if self.fused:
+            step = self.step_fused if mask is None else self.step_fused_mask
+            prepare = lambda X, *m: [T.dot(X, self.w) + self.b] + list(m)
+            non_sequences = [self.u_zr, self.u_h]
+        else:
+            step = self.step if mask is None else self.step_mask
+            prepare = lambda X, *m: [T.dot(X, self.w_z) + self.b_z, T.dot(X, self.w_r) + self.b_r,
+                                     T.dot(X, self.w_h) + self.b_h] + list(m)
+            non_sequences = [self.u_z, self.u_r, self.u_h]
+        H = checkpoint_scan(lambda *args: step(*args)[0], prepare, sequences, H0, non_sequences, self.checkpoint)
+        return (H.dimshuffle((1,0,2)), None, None)
+
+    def stream(self, x_t, states):
+        [h_tm1] = states
+        if self.fused:
+            h_t, _, _ = self.step_fused(T.dot(x_t, self.w) + self.b, h_tm1, self.u_zr, self.u_h)
+        else:
+            h_t, _, _ = self.step(T.dot(x_t, self.w_z) + self.b_z, T.dot(x_t, self.w_r) + self.b_r,
+                                  T.dot(x_t, self.w_h) + self.b_h, h_tm1, self.u_z, self.u_r, self.u_h)
+        return (h_t, [h_t])
+
+    def stream_init(self, batch_size, h0=None):
+        return [initial_state(self.size, batch_size, h0)]
+
+    def _call_fused(self, h0, seq, repeat_h0=0, mask=None):
+        X = seq.dimshuffle((1,0,2))
+        H0 = T.repeat(h0, X.shape[1], axis=0) if repeat_h0 else h0
+        x = T.dot(X, self.w) + self.b
+        if mask is None:
+            step, sequences = self.step_fused, [x]
+        else:
+            step, sequences = self.step_fused_mask, [x, mask.dimshuffle((1,0,'x'))]
+        out, _ = theano.scan(step,
+                             sequences=sequences,
+                             outputs_info=[H0, None, None],
+                             non_sequences=[self.u_zr, self.u_h],
+                             go_backwards=self.backward
+        )
+        return (out[0].dimshuffle((1,0,2)), out[1].dimshuffle((1,0,2)), out[2].dimshuffle((1,0,2)))
+
 class GRU(Layer):
     """Gated Recurrent Unit layer. Takes initial hidden state, and a
        sequence of inputs, and returns the sequence of hidden states.
@@ -242,8 +477,20 @@ class GRU(Layer):
     def params(self):
         return self.gru.params()
 
-    def __call__(self, h0, seq, repeat_h0=1):
-        H, _, _ = self.gru(h0, seq, repeat_h0=repeat_h0)
+    def borrow_params(self, ps):
+        self.gru.borrow_params(ps)
+
+    def param_span(self, ps):
+        return self.gru.param_span(ps)
+
+    def stream(self, x_t, states):
+        return self.gru.stream(x_t, states)
+
+    def stream_init(self, batch_size, h0=None):
+        return self.gru.stream_init(batch_size, h0=h0)
+
+    def __call__(self, h0, seq, repeat_h0=1, mask=None):
+        H, _, _ = self.gru(h0, seq, repeat_h0=repeat_h0, mask=mask)
         return H
 
 class BidiGRU(Layer):
@@ -263,14 +510,20 @@ class BidiGRU(Layer):
     def params(self):
         return params(self.gru_f, self.gru_b)
 
-    def __call__(self, h0, seq, repeat_h0=1):
-        H_f, _, _ = self.gru_f(h0, seq, repeat_h0=repeat_h0)
-        H_b, _, _ = self.gru_b(h0, seq, repeat_h0=repeat_h0)
+    def borrow_params(self, ps):
+        borrow_params(ps, self.gru_f, self.gru_b)
+
+    def param_span(self, ps):
+        return param_span(ps, self.gru_f, self.gru_b)
+
+    def __call__(self, h0, seq, repeat_h0=1, mask=None):
+        H_f, _, _ = self.gru_f(h0, seq, repeat_h0=repeat_h0, mask=mask)
+        H_b, _, _ = self.gru_b(h0, seq, repeat_h0=repeat_h0, mask=mask)
         return H_f + H_b
 
-    def bidi(self, h0, seq, repeat_h0=1):
-        H_f, _, _ = self.gru_f(h0, seq, repeat_h0=repeat_h0)
-        H_b, _, _ = self.gru_b(h0, seq, repeat_h0=repeat_h0)
+    def bidi(self, h0, seq, repeat_h0=1, mask=None):
+        H_f, _, _ = self.gru_f(h0, seq, repeat_h0=repeat_h0, mask=mask)
+        H_b, _, _ = self.gru_b(h0, seq, repeat_h0=repeat_h0, mask=mask)
         return (H_f, H_b)
 
 
@@ -306,14 +559,26 @@ class WithH0(Layer):
     def params(self):
         return params(self.h0, self.layer)
 
-    def __call__(self, inp):
-        return self.layer(self.h0(), inp, repeat_h0=1)
+    def borrow_params(self, ps):
+        borrow_params(ps, self.h0, self.layer)
 
-    def bidi(self, inp):
-        return self.layer.bidi(self.h0(), inp, repeat_h0=1)
+    def param_span(self, ps):
+        return param_span(ps, self.h0, self.layer)
 
-    def intermediate(self, inp):
-        return self.layer.intermediate(self.h0(), inp, repeat_h0=1)
+    def stream(self, x_t, states):
+        return self.layer.stream(x_t, states)
+
+    def stream_init(self, batch_size, h0=None):
+        return self.layer.stream_init(batch_size, h0=self.h0())
+
+    def __call__(self, inp, mask=None):
+        return self.layer(self.h0(), inp, repeat_h0=1, mask=mask)
+
+    def bidi(self, inp, mask=None):
+        return self.layer.bidi(self.h0(), inp, repeat_h0=1, mask=mask)
+
+    def intermediate(self, inp, mask=None):
+        return self.layer.intermediate(self.h0(), inp, repeat_h0=1, mask=mask)
 
 def GRUH0(size_in, size, fixed=False, **kwargs):
     """A GRU layer with its own initial state."""
@@ -335,6 +600,12 @@ class WithDropout(Layer):
     def params(self):
         return params(self.layer, self.Dropout)
 
+    def borrow_params(self, ps):
+        borrow_params(ps, self.layer, self.Dropout)
+
+    def param_span(self, ps):
+        return param_span(ps, self.layer, self.Dropout)
+
     def __call__(self, *args, **kwargs):
         return self.Dropout(self.layer(*args, **kwargs))
 
@@ -354,6 +625,8 @@ class EncoderDecoderGRU(Layer):
     Args:
       inp (tensor3) - input sequence
       out_prev (tensor3) - sequence of output elements at position -1
+      mask_inp (matrix) - optional mask for padding in input sequence
+      mask_out (matrix) - optional mask for padding in output sequence
 
     Returns:
       tensor3 - sequence of states (one for each element of output sequence)
@@ -368,8 +641,25 @@ class EncoderDecoderGRU(Layer):
     def params(self):
         return params(self.Encode, self.Decode)
 
-    def __call__(self, inp, out_prev):
-        return self.Decode(last(self.Encode(inp)), out_prev)
+    def borrow_params(self, ps):
+        borrow_params(ps, self.Encode, self.Decode)
+
+    def param_span(self, ps):
+        return param_span(ps, self.Encode, self.Decode)
+
+    def __call__(self, inp, out_prev, mask_inp=None, mask_out=None):
+        return self.Decode(last(self.Encode(inp, mask=mask_inp)), out_prev, mask=mask_out)
+
+    def decode_init(self, inp, mask_inp=None):
+        """Return initial decoder states for step-wise decoding of `inp`,
+        for use with `decode_step`."""
+        h = last(self.Encode(inp, mask=mask_inp))
+        return [h] + self.Decode.stream_init(h.shape[0])[1:]
+
+    def decode_step(self, out_prev_t, states):
+        """Decode one step, given the previous output element `out_prev_t`
+        (matrix). Returns the state and the new decoder states."""
+        return self.Decode.stream(out_prev_t, states)
 
 
 class StackedGRU(Layer):
@@ -388,13 +678,27 @@ class StackedGRU(Layer):
     def params(self):
         return params(self.Dropout0, self.bottom, self.stack)
 
-    def __call__(self, h0, inp, repeat_h0=0):
-        return self.stack(self.bottom(h0, self.Dropout0(inp), repeat_h0=repeat_h0))
+    def borrow_params(self, ps):
+        borrow_params(ps, self.Dropout0, self.bottom, self.stack)
 
-    def intermediate(self, h0, inp, repeat_h0=0):
-        zs = [ self.bottom(h0, self.Dropout0(inp), repeat_h0=repeat_h0) ]
+    def param_span(self, ps):
+        return param_span(ps, self.Dropout0, self.bottom, self.stack)
+
+    def __call__(self, h0, inp, repeat_h0=0, mask=None):
+        return self.stack(self.bottom(h0, self.Dropout0(inp), repeat_h0=repeat_h0, mask=mask), mask=mask)
+
+    def stream(self, x_t, states):
+        h_t, [h_bottom] = self.bottom.stream(self.Dropout0(x_t), states[:1])
+        y_t, states_stack = self.stack.stream(h_t, states[1:])
+        return (y_t, [h_bottom] + states_stack)
+
+    def stream_init(self, batch_size, h0=None):
+        return self.bottom.stream_init(batch_size, h0=h0) + self.stack.stream_init(batch_size)
+
+    def intermediate(self, h0, inp, repeat_h0=0, mask=None):
+        zs = [ self.bottom(h0, self.Dropout0(inp), repeat_h0=repeat_h0, mask=mask) ]
         for layer in self.layers:
-            z = layer(zs[-1])
+            z = layer(zs[-1], mask=mask)
             zs.append(z)
         return theano.tensor.stack(* zs).dimshuffle((1,2,0,3)) # FIXME deprecated interface
 
@@ -415,10 +719,32 @@ def StackedGRUH0(size_in, size, depth, fixed=False, **kwargs):
     else:
         return WithH0(Zeros(size), StackedGRU(size_in, size, depth, **kwargs))
 
-try:
-    from theano.gpuarray.dnn import dnn_conv
-except ImportError:
-    from theano.sandbox.cuda.dnn import dnn_conv
+def gpu_conv():
+    """Return cuDNN convolution if Theano is configured to use a GPU and
+    cuDNN is available, else None. The GPU backend is imported on first use."""
+    if not theano.config.device.startswith(('cuda', 'gpu')):
+        return None
+    try:
+        from theano.gpuarray.dnn import dnn_conv, dnn_available
+        return dnn_conv if dnn_available(None) else None
+    except ImportError:
+        pass
+    try:
+        from theano.sandbox.cuda.dnn import dnn_conv, dnn_available
+        return dnn_conv if dnn_available() else None
+    except ImportError:
+        return None
+
+def conv_full(seq, W, stride=1):
+    """Full convolution of `seq` with `W` along dimension 2, keeping every
+    `stride`-th output. Uses cuDNN on the GPU, and T.nnet.conv2d otherwise."""
+    dnn_conv = gpu_conv()
+    if dnn_conv is not None:
+        return dnn_conv(seq, W, border_mode='full', subsample=(stride, 1))
+    else:
+        # T.nnet.conv2d crashes when using non-unit stride
+        result = T.nnet.conv2d(seq, W, border_mode='full')
+        return result if stride == 1 else result[:, :, ::stride, :]
 
 
 class Convolution1D(Layer):
@@ -431,10 +757,7 @@ class Convolution1D(Layer):
 
     def __call__(self, seq):
         seq = expand_dims(seq, -1).dimshuffle((0,2,1,3))
-        #result = T.nnet.conv2d(seq, self.W, border_mode='full', subsample=(self.stride, 1))
-        # T.nnet.conv2d crashes when using non-unit stride
-
-        result = dnn_conv(seq, self.W, border_mode='full', subsample=(self.stride, 1))
+        result = conv_full(seq, self.W, stride=self.stride)
         result = squeeze(result, 3).dimshuffle((0,2,1))
         return self.activation(result)
 
@@ -483,3 +806,156 @@ class Attention(Layer):
     def __call__(self, h):
         alpha = softmax_time(self.Regress2(self.activation(self.Regress1(h))))
         return T.sum(alpha.repeat(self.size_in, axis=2) * h, axis=1)
+
+
+def flatten_time(x):
+    """Reshape input of shape ... x size to matrix of shape N x size."""
+    return x.reshape((-1, x.shape[-1]))
+
+class Softmax(Layer):
+    """Softmax output layer over the vocabulary of `embedding`, whose
+    weights are shared with the embedding. Maps a sequence of states to a
+    sequence of distributions over the vocabulary."""
+    def __init__(self, embedding):
+        autoassign(locals())
+
+    def params(self):
+        return []
+
+    def __call__(self, inp):
+        return softmax3d(self.embedding.unembed(inp))
+
+    def log_probs(self, inp):
+        """Log-probabilities over the vocabulary, for input of any rank."""
+        return log_softmax(self.embedding.unembed(flatten_time(inp))).reshape(
+            T.concatenate([inp.shape[:-1], [self.embedding.size_in]]), ndim=inp.ndim)
+
+    def cost(self, inp, target, mask=None):
+        """Training cost: cross-entropy of `target` (matrix of ids)."""
+        return SoftmaxCrossEntropy(target, self.embedding.unembed(inp), mask=mask)
+
+class SampledSoftmax(Softmax):
+    """Softmax output layer tied to `embedding`, trained with sampled
+    softmax: the cost normalizes over the target and `num_sampled` words
+    drawn from a proposal distribution proportional to `freq`**`power`
+    (uniform if `freq` is None), instead of the whole vocabulary. The full
+    softmax is used for prediction."""
+    def __init__(self, embedding, num_sampled=512, freq=None, power=0.75):
+        autoassign(locals())
+        size = self.embedding.size_in
+        q = numpy.ones(size) if freq is None else (numpy.asarray(freq, dtype='float64') + 1) ** power
+        q = q / q.sum()
+        self.cdf = numpy.cumsum(q)
+        # Log of expected number of times each word is sampled
+        self.log_q = numpy.log(q * self.num_sampled)
+        from theano.sandbox.rng_mrg import MRG_RandomStreams
+        self.rstream = MRG_RandomStreams(seed=numpy.random.randint(10e6))
+
+    def sample(self):
+        u = self.rstream.uniform((self.num_sampled,), dtype=theano.config.floatX)
+        ids = T.extra_ops.searchsorted(T.constant(floatX(self.cdf)), u, side='right')
+        return T.minimum(ids, self.embedding.size_in - 1)
+
+    def cost(self, inp, target, mask=None):
+        """Training cost: sampled softmax cross-entropy of `target` (matrix of ids)."""
+        x = flatten_time(inp)
+        t = target.flatten()
+        s = self.sample()
+        E = self.embedding.E
+        log_q = T.constant(floatX(self.log_q))
+        true = (x * E[t]).sum(axis=1) - log_q[t]
+        sampled = T.dot(x, E[s].T) - log_q[s]
+        # Sampled copies of the target do not count as negatives
+        sampled = T.switch(T.eq(t.dimshuffle(0, 'x'), s.dimshuffle('x', 0)), -1e6, sampled)
+        logits = T.concatenate([true.dimshuffle(0, 'x'), sampled], axis=1)
+        return SoftmaxCrossEntropy(T.zeros_like(t), logits, mask=mask)
+
+class ClassSoftmax(Layer):
+    """Class-based (two-level hierarchical) softmax over `size_out` words:
+    the probability of a word is the probability of its class times the
+    probability of the word within the class. Words are split into
+    `n_classes` classes of equal size (by default about sqrt(size_out)),
+    in order of decreasing `freq` if given, else in order of id."""
+    def __init__(self, size_in, size_out, n_classes=None, freq=None):
+        autoassign(locals())
+        if self.n_classes is None:
+            self.n_classes = int(numpy.ceil(numpy.sqrt(self.size_out)))
+        self.per_class = int(numpy.ceil(self.size_out / float(self.n_classes)))
+        order = numpy.arange(self.size_out) if freq is None else numpy.argsort(-numpy.asarray(freq), kind='mergesort')
+        # Position of each word among the outputs of h_softmax
+        self.slot = numpy.empty(self.size_out, dtype='int32')
+        self.slot[order] = numpy.arange(self.size_out)
+        self.W1 = uniform((self.size_in, self.n_classes))
+        self.b1 = shared0s((self.n_classes,))
+        self.W2 = uniform((self.n_classes, self.size_in, self.per_class))
+        # Unused slots at the end of the last class get no probability
+        b2 = numpy.zeros(self.n_classes * self.per_class)
+        b2[self.size_out:] = -1e4
+        self.b2 = sharedX(b2.reshape((self.n_classes, self.per_class)))
+
+    def params(self):
+        return [self.W1, self.b1, self.W2, self.b2]
+
+    def h_softmax(self, x, target=None):
+        return T.nnet.h_softmax(x, x.shape[0], self.size_out, self.n_classes, self.per_class,
+                                self.W1, self.b1, self.W2, self.b2, target=target)
+
+    def __call__(self, inp):
+        p = self.h_softmax(flatten_time(inp))[:, self.slot]
+        return p.reshape(T.concatenate([inp.shape[:-1], [self.size_out]]), ndim=inp.ndim)
+
+    def log_probs(self, inp):
+        """Log-probabilities over the vocabulary, for input of any rank."""
+        return T.log(T.clip(self(inp), epsilon, 1.0))
+
+    def cost(self, inp, target, mask=None):
+        """Training cost: cross-entropy of `target` (matrix of ids),
+        computed from the target's class and the words in that class only."""
+        p = self.h_softmax(flatten_time(inp), target=T.constant(self.slot)[target.flatten()])
+        return masked_mean(-T.log(T.clip(p, epsilon, 1.0)), mask)
+
+
+class Stepper(object):
+    """Compiled single-step function of a layer, for streaming inference.
+
+    Takes a time step of input `x` (by default a matrix of shape batch x
+    size_in) and the list of recurrent states of the layer, and returns the
+    output and the new states. Dropout is disabled.
+    """
+    def __init__(self, layer, x=None):
+        self.layer = layer
+        x_t = T.matrix() if x is None else x
+        states = [ T.matrix() for _ in layer.stream_init(1) ]
+        with context.context(training=False):
+            y_t, new_states = layer.stream(x_t, states)
+        self.step = theano.function([x_t] + states, [y_t] + new_states)
+        batch_size = T.iscalar()
+        self.init = theano.function([batch_size], layer.stream_init(batch_size), on_unused_input='ignore')
+
+    def __call__(self, x_t, states):
+        out = self.step(x_t, *states)
+        return (out[0], out[1:])
+
+    def initial(self, batch_size=1):
+        """Return initial states for `batch_size` sequences."""
+        return self.init(batch_size)
+
+    def session(self, batch_size=1):
+        return Session(self, batch_size=batch_size)
+
+class Session(object):
+    """Carries the recurrent states of a Stepper across calls, so that each
+    new time step costs one step of computation."""
+    def __init__(self, stepper, batch_size=1):
+        self.stepper = stepper
+        self.batch_size = batch_size
+        self.reset()
+
+    def reset(self):
+        """Start new sequences."""
+        self.states = self.stepper.initial(self.batch_size)
+
+    def __call__(self, x_t):
+        """Feed the next time step, and return the output for it."""
+        y_t, self.states = self.stepper(x_t, self.states)
+        return y_t
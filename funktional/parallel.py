@@ -0,0 +1,143 @@
+# encoding: utf-8
+"""Data-parallel training in several processes on one machine.
+
+`DataParallel` splits each minibatch into one shard per process. The
+calling process and `workers - 1` forked worker processes each compute
+the gradients of the cost on their shard, and write them to a row of a
+gradient buffer in shared memory. The calling process averages the rows,
+weighted by the size of each shard, and applies the update once. It then
+copies the new parameter values to a shared parameter buffer, which the
+workers read before computing their next gradients. Each step therefore
+equals a single-process step on the whole minibatch, as long as the cost
+is a weighted mean over examples.
+
+Workers are forked when `DataParallel` is created, so functions must be
+compiled and parameters initialized before. Random streams are forked
+too, so the workers draw the same random numbers (such as dropout masks)
+on their different shards.
+
+>>> grad = theano.function(inputs, [cost] + T.grad(cost, params))
+>>> gs = [ p.type() for p in params ]
+>>> apply = theano.function(gs, [], updates=Adam().get_updates(params, None, grads=gs))
+>>> train = DataParallel(grad, apply, params, workers=4)
+>>> cost = train(x, y)
+"""
+import multiprocessing
+import numpy
+
+def split(inputs, n):
+    """Split each of `inputs` along the first axis into `n` shards, and
+    return the list of non-empty shards."""
+    parts = [ numpy.array_split(x, n) for x in inputs ]
+    return [ shard for shard in zip(*parts) if len(shard[0]) > 0 ]
+
+def shared_buffer(shape, dtype):
+    """Return array of zeros of `shape` in memory shared with forked processes."""
+    dtype = numpy.dtype(dtype)
+    raw = multiprocessing.RawArray('b', int(numpy.prod(shape)) * dtype.itemsize)
+    return numpy.frombuffer(raw, dtype=dtype).reshape(shape)
+
+def get_flat(variables, out):
+    """Copy the values of shared `variables` into the flat array `out`."""
+    offset = 0
+    for v in variables:
+        value = v.get_value(borrow=True)
+        out[offset:offset+value.size] = value.ravel()
+        offset += value.size
+
+def set_flat(variables, flat):
+    """Set the values of shared `variables` from the flat array `flat`."""
+    offset = 0
+    for v in variables:
+        shape = v.get_value(borrow=True).shape
+        size = int(numpy.prod(shape))
+        v.set_value(flat[offset:offset+size].reshape(shape))
+        offset += size
+
+def put_flat(arrays, out):
+    """Copy `arrays` into the flat array `out`."""
+    offset = 0
+    for a in arrays:
+        out[offset:offset+a.size] = a.ravel()
+        offset += a.size
+
+def unflatten(flat, shapes):
+    """Split the flat array `flat` into arrays of `shapes`."""
+    arrays = []
+    offset = 0
+    for shape in shapes:
+        size = int(numpy.prod(shape))
+        arrays.append(flat[offset:offset+size].reshape(shape))
+        offset += size
+    return arrays
+
+class DataParallel(object):
+    """Trains in `workers` processes. `grad` takes a shard of the inputs
+    and returns the cost followed by the gradients of `params`; `apply`
+    takes the averaged gradients and updates `params`. `weight` returns
+    the weight of a shard in the average, by default its number of
+    examples. Calling it with a minibatch runs one step, and returns the
+    weighted mean of the costs."""
+    def __init__(self, grad, apply, params, workers=2, weight=None):
+        self.grad = grad
+        self.apply = apply
+        self.params = params
+        self.workers = workers
+        self.weight = (lambda shard: len(shard[0])) if weight is None else weight
+        self.shapes = [ p.get_value(borrow=True).shape for p in params ]
+        dtype = params[0].get_value(borrow=True).dtype
+        size = sum(int(numpy.prod(shape)) for shape in self.shapes)
+        self.grads = shared_buffer((workers, size), dtype)
+        self.values = shared_buffer((size,), dtype)
+        get_flat(self.params, self.values)
+        self.conns = []
+        self.processes = []
+        for i in range(1, workers):
+            conn, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=self._work, args=(i, child))
+            process.daemon = True
+            process.start()
+            self.conns.append(conn)
+            self.processes.append(process)
+
+    def _work(self, i, conn):
+        while True:
+            shard = conn.recv()
+            if shard is None:
+                return
+            try:
+                set_flat(self.params, self.values)
+                out = self.grad(*shard)
+                put_flat(out[1:], self.grads[i])
+                conn.send((out[0], None))
+            except Exception as e:
+                conn.send((None, e))
+
+    def __call__(self, *inputs):
+        shards = split(inputs, self.workers)
+        for conn, shard in zip(self.conns, shards[1:]):
+            conn.send(shard)
+        try:
+            out = self.grad(*shards[0])
+            put_flat(out[1:], self.grads[0])
+        finally:
+            # Collect the results of all workers, so that the next step starts in sync
+            results = [ conn.recv() for conn, _ in zip(self.conns, shards[1:]) ]
+        for _, error in results:
+            if error is not None:
+                raise error
+        costs = [out[0]] + [ cost for cost, _ in results ]
+        weights = numpy.array([ self.weight(shard) for shard in shards ], dtype=self.grads.dtype)
+        weights = weights / weights.sum()
+        self.apply(*unflatten(numpy.dot(weights, self.grads[:len(shards)]), self.shapes))
+        get_flat(self.params, self.values)
+        return numpy.dot(weights, costs)
+
+    def close(self):
+        """Stop the worker processes."""
+        for conn in self.conns:
+            conn.send(None)
+        for process in self.processes:
+            process.join()
+        self.conns = []
+        self.processes = []
@@ -5,10 +5,9 @@ import numpy as np
 import theano
 import theano.tensor as tt
 from theano.ifelse import ifelse
-from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 import numbers
 import funktional.context as context
-from funktional.layer import Layer, WithH0, FixedZeros, Zeros, Identity, Residual, params
+from funktional.layer import Layer, WithH0, FixedZeros, Zeros, Identity, Residual, params, initial_state, checkpoint_scan
 from funktional.util import autoassign
 from  functools import reduce
 floatX = theano.config.floatX
@@ -55,10 +54,16 @@ class RHN(Layer):
     https://arxiv.org/abs/1607.03474 and
     https://github.com/julian121266/RecurrentHighwayNetworks.
 
+    If `checkpoint` is an integer k, the sequence is processed in segments
+    of k steps. The hidden states of all steps are kept for
+    backpropagation, but the intermediate results of the recurrence
+    layers are recomputed segment by segment in the backward pass.
     """
     def __init__(self, size_in, size, recur_depth=1, drop_i=0.75 , drop_s=0.25,
-                 init_T_bias=-2.0, init_H_bias='uniform', tied_noise=True, init_scale=0.04, seed=1):
+                 init_T_bias=-2.0, init_H_bias='uniform', tied_noise=True, init_scale=0.04, seed=1,
+                 checkpoint=None):
         autoassign(locals())
+        from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
         self._theano_rng = RandomStreams(self.seed // 2 + 321)
         #self._np_rng = np.random.RandomState(self.seed // 2 + 123)
         # self._is_training = tt.iscalar('is_training')
@@ -76,6 +81,10 @@ class RHN(Layer):
                 self.recurT.append(Linear(in_size=hidden_size, out_size=hidden_size, bias_init=self.init_T_bias))
 
 
+    def __setstate__(self, state):
+        state.setdefault('checkpoint', None)
+        self.__dict__.update(state)
+
     def apply_dropout(self, x, noise):
         if context.training:
             return noise * x
@@ -115,7 +124,21 @@ class RHN(Layer):
         y_t = s_l
         return y_t
 
-    def __call__(self, h0, seq, repeat_h0=1):
+    def step_mask(self, i_for_H_t, i_for_T_t, m_t, h_tm1, noise_s):
+        """Like `step`, but keeps the previous state where `m_t` is zero."""
+        y_t = self.step(i_for_H_t, i_for_T_t, h_tm1, noise_s)
+        return m_t * y_t + (1 - m_t) * h_tm1
+
+    def stream(self, x_t, states):
+        # Dropout noise is not used outside of training
+        noise_s = None if self.tied_noise else (None, None)
+        h_t = self.step(self.LinearH(x_t), self.LinearT(x_t), states[0], noise_s)
+        return (h_t, [h_t])
+
+    def stream_init(self, batch_size, h0=None):
+        return [initial_state(self.size, batch_size, h0)]
+
+    def __call__(self, h0, seq, repeat_h0=1, mask=None):
         inputs = seq.dimshuffle((1,0,2))
         (_seq_size, batch_size, _) = inputs.shape
         hidden_size = self.size
@@ -137,8 +160,19 @@ class RHN(Layer):
           noise_s = tt.stack(noise_s, self.get_dropout_noise((batch_size, hidden_size), self.drop_s))
 
         H0 = tt.repeat(h0, inputs.shape[1], axis=0) if repeat_h0 else h0
-        out, _ = theano.scan(self.step,
-                             sequences=[i_for_H, i_for_T],
+        if self.checkpoint:
+            sequences = [inputs] if mask is None else [inputs, mask.dimshuffle((1,0,'x'))]
+            prepare = lambda x, *m: [self.LinearH(self.apply_dropout(x, noise_i_for_H)),
+                                     self.LinearT(self.apply_dropout(x, noise_i_for_T))] + list(m)
+            step = self.step if mask is None else self.step_mask
+            out = checkpoint_scan(step, prepare, sequences, H0, [noise_s], self.checkpoint)
+            return out.dimshuffle((1, 0, 2))
+        if mask is None:
+            step, sequences = self.step, [i_for_H, i_for_T]
+        else:
+            step, sequences = self.step_mask, [i_for_H, i_for_T, mask.dimshuffle((1,0,'x'))]
+        out, _ = theano.scan(step,
+                             sequences=sequences,
                              outputs_info=[H0],
                              non_sequences = [noise_s])
         return out.dimshuffle((1, 0, 2))
@@ -166,13 +200,21 @@ class StackedRHN(Layer):
     def params(self):
         return params(self.bottom, self.stack)
 
-    def __call__(self, h0, inp, repeat_h0=0):
-        return self.stack(self.bottom(h0, inp, repeat_h0=repeat_h0))
+    def __call__(self, h0, inp, repeat_h0=0, mask=None):
+        return self.stack(self.bottom(h0, inp, repeat_h0=repeat_h0, mask=mask), mask=mask)
+
+    def stream(self, x_t, states):
+        h_t, [h_bottom] = self.bottom.stream(x_t, states[:1])
+        y_t, states_stack = self.stack.stream(h_t, states[1:])
+        return (y_t, [h_bottom] + states_stack)
+
+    def stream_init(self, batch_size, h0=None):
+        return self.bottom.stream_init(batch_size, h0=h0) + self.stack.stream_init(batch_size)
 
-    def intermediate(self, h0, inp, repeat_h0=0):
-        zs = [ self.bottom(h0, inp, repeat_h0=repeat_h0) ]
+    def intermediate(self, h0, inp, repeat_h0=0, mask=None):
+        zs = [ self.bottom(h0, inp, repeat_h0=repeat_h0, mask=mask) ]
         for layer in self.layers:
-            z = layer(zs[-1])
+            z = layer(zs[-1], mask=mask)
             zs.append(z)
         return theano.tensor.stack(* zs).dimshuffle((1,2,0,3)) # FIXME deprecated interface
 
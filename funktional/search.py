@@ -0,0 +1,69 @@
+# encoding: utf-8
+"""Batched beam search and greedy decoding.
+
+The decoder is given as a function `step(prev, states)`, taking the
+vector of previously output symbols and a list of state arrays (one row
+per hypothesis), and returning the log-probabilities of the next symbol
+(hypotheses x vocabulary) and the new states. All hypotheses of all
+sentences in a batch are advanced by a single call of `step`.
+"""
+import numpy
+
+def strip(tokens, END):
+    """Return `tokens` up to the first `END`, as a list."""
+    tokens = list(tokens)
+    return tokens[:tokens.index(END)] if END in tokens else tokens
+
+def beam_search(step, states, BEG, END, size=1, max_len=50):
+    """Decode from initial `states` (one row per sentence), keeping the
+    `size` best hypotheses of each sentence. A sentence is done when its
+    best hypothesis ends with `END`, and is then dropped from the batch.
+
+    Returns the list of best output sequences (without `END`), and the
+    array of their log-probabilities.
+    """
+    N = len(states[0])
+    K = size
+    states = [ numpy.repeat(s, K, axis=0) for s in states ]
+    # Only the first hypothesis of each sentence is expanded at the first step
+    scores = numpy.tile([0.0] + [-numpy.inf] * (K-1), N)
+    tokens = numpy.zeros((N*K, 0), dtype='int32')
+    finished = numpy.zeros(N*K, dtype=bool)
+    prev = numpy.empty(N*K, dtype='int32')
+    prev.fill(BEG)
+    alive = numpy.arange(N)
+    results = [ None for _ in range(N) ]
+    result_scores = numpy.zeros(N)
+    for t in range(max_len):
+        logp, states = step(prev, states)
+        # Finished hypotheses are extended with END at no cost
+        logp = numpy.where(finished[:, None], -numpy.inf, logp)
+        logp[finished, END] = 0.0
+        V = logp.shape[1]
+        cand = (scores[:, None] + logp).reshape((len(alive), K*V))
+        best = numpy.argpartition(-cand, K-1, axis=1)[:, :K]
+        rank = numpy.arange(len(alive))[:, None]
+        best = best[rank, numpy.argsort(-cand[rank, best], axis=1)]
+        rows = (rank * K + best // V).ravel()
+        words = (best % V).ravel().astype('int32')
+        scores = cand[rank, best].ravel()
+        tokens = numpy.hstack([tokens[rows], words[:, None]])
+        finished = finished[rows] | (words == END)
+        states = [ s[rows] for s in states ]
+        prev = words
+        # Later steps cannot increase scores, so a finished best hypothesis is final
+        done = finished[::K] if t < max_len - 1 else numpy.ones(len(alive), dtype=bool)
+        for j in numpy.nonzero(done)[0]:
+            results[alive[j]] = strip(tokens[j*K], END)
+            result_scores[alive[j]] = scores[j*K]
+        keep = numpy.repeat(~done, K)
+        alive = alive[~done]
+        if len(alive) == 0:
+            break
+        states = [ s[keep] for s in states ]
+        scores, tokens, finished, prev = scores[keep], tokens[keep], finished[keep], prev[keep]
+    return (results, result_scores)
+
+def greedy_search(step, states, BEG, END, max_len=50):
+    """Decode by choosing the most probable symbol at each step."""
+    return beam_search(step, states, BEG, END, size=1, max_len=max_len)
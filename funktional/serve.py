@@ -0,0 +1,191 @@
+# encoding: utf-8
+"""Serving models with dynamic micro-batching.
+
+`MicroBatcher` coalesces items submitted concurrently from many threads
+into batches of items of similar length, and runs a batch function once
+per batch in a worker thread. A batch is run as soon as it is full, or
+when its oldest item has waited `max_latency` seconds. `Server` exposes a
+batcher over TCP, with one JSON object per line, and `Client` talks to it:
+
+>>> batcher = MicroBatcher(project, max_batch=128, max_latency=0.01)
+>>> server = Server(('localhost', 8000), batcher)
+>>> threading.Thread(target=server.serve_forever).start()
+>>> Client('localhost', 8000)(['a', 'sentence'])
+"""
+import json
+import time
+import socket
+import threading
+import collections
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+class Pending(object):
+    """Result of a submitted item, available once its batch has run."""
+    def __init__(self, item):
+        self.item = item
+        self.time = time.time()
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def set(self, value, error=None):
+        self.value = value
+        self.error = error
+        self.event.set()
+
+    def result(self, timeout=None):
+        """Wait for and return the result, raising the error of the batch if it failed."""
+        if not self.event.wait(timeout):
+            raise RuntimeError("Timed out waiting for result")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class MicroBatcher(object):
+    """Runs `fn` on batches of submitted items. `fn` takes a list of items
+    and returns a sequence of results in the same order. Items are grouped
+    in buckets of width `bucket_width` by `key`, and batches are formed
+    within a bucket, of at most `max_batch` items."""
+    def __init__(self, fn, max_batch=128, max_latency=0.01, bucket_width=5, key=len):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.bucket_width = bucket_width
+        self.key = key
+        self.cond = threading.Condition()
+        self.buckets = {}
+        self.depth = 0
+        self.closed = False
+        self.batch_sizes = collections.Counter()
+        self.queue_depths = collections.Counter()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, item):
+        """Queue `item`, and return its Pending result."""
+        pending = Pending(item)
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("MicroBatcher is closed")
+            self.buckets.setdefault(self.key(item) // self.bucket_width, []).append(pending)
+            self.depth += 1
+            self.queue_depths[self.depth] += 1
+            self.cond.notify()
+        return pending
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    def _next(self):
+        """Wait for the next batch to run, or return None once closed and drained."""
+        with self.cond:
+            while True:
+                now = time.time()
+                ready = None
+                wake = None
+                for b, queue in self.buckets.items():
+                    deadline = queue[0].time + self.max_latency
+                    if len(queue) >= self.max_batch or deadline <= now or self.closed:
+                        if ready is None or queue[0].time < self.buckets[ready][0].time:
+                            ready = b
+                    else:
+                        wake = deadline if wake is None else min(wake, deadline)
+                if ready is not None:
+                    queue = self.buckets.pop(ready)
+                    batch, rest = queue[:self.max_batch], queue[self.max_batch:]
+                    if rest:
+                        self.buckets[ready] = rest
+                    self.depth -= len(batch)
+                    return batch
+                if self.closed:
+                    return None
+                self.cond.wait(None if wake is None else wake - now)
+
+    def _run(self):
+        while True:
+            batch = self._next()
+            if batch is None:
+                return
+            self.batch_sizes[len(batch)] += 1
+            try:
+                results = self.fn([ p.item for p in batch ])
+            except Exception as e:
+                for p in batch:
+                    p.set(None, error=e)
+            else:
+                for p, r in zip(batch, results):
+                    p.set(r)
+
+    def close(self):
+        """Run the remaining items, and stop the worker thread."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+    def stats(self):
+        """Return counts of requests and batches, and histograms of batch
+        sizes and of queue depths seen by arriving items."""
+        return dict(requests=sum(k * v for k, v in self.batch_sizes.items()),
+                    batches=sum(self.batch_sizes.values()),
+                    batch_sizes=dict(self.batch_sizes),
+                    queue_depths=dict(self.queue_depths))
+
+def jsonable(x):
+    return x.tolist() if hasattr(x, 'tolist') else x
+
+class Handler(socketserver.StreamRequestHandler):
+    """Handles requests, one JSON object per line: {"input": item} is
+    answered with {"output": result}, and {"stats": true} with the stats
+    of the batcher."""
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if request.get('stats'):
+                    stats = self.server.batcher.stats()
+                    response = dict((k, dict((str(n), c) for n, c in v.items()) if isinstance(v, dict) else v)
+                                    for k, v in stats.items())
+                else:
+                    response = dict(output=jsonable(self.server.batcher(request['input'])))
+            except Exception as e:
+                response = dict(error=repr(e))
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """TCP server answering requests with `batcher`, one thread per connection."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, batcher):
+        socketserver.TCPServer.__init__(self, address, Handler)
+        self.batcher = batcher
+
+class Client(object):
+    """Client of a `Server`. Calling it with an item returns the result."""
+    def __init__(self, host='localhost', port=8000):
+        self.sock = socket.create_connection((host, port))
+        self.file = self.sock.makefile('rwb')
+
+    def request(self, request):
+        self.file.write((json.dumps(request) + '\n').encode('utf-8'))
+        self.file.flush()
+        response = json.loads(self.file.readline().decode('utf-8'))
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def __call__(self, item):
+        return self.request(dict(input=item))['output']
+
+    def stats(self):
+        return self.request(dict(stats=True))
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
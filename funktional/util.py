@@ -7,6 +7,13 @@ import theano
 import theano.tensor as T
 import numpy as np
 import itertools
+import collections
+import multiprocessing
+import multiprocessing.pool
+import os
+import time
+import random
+import copy
 from theano.tensor.extra_ops import fill_diagonal
 
 class IdTable(object):
@@ -30,6 +37,16 @@ class IdTable(object):
     def from_id(self, i):
         return self.decoder[i]
 
+    def decoder_array(self):
+        """Return array of objects indexed by id."""
+        cached = getattr(self, '_decoder_array', None)
+        if cached is None or len(cached) != self.max:
+            cached = np.empty(self.max, dtype=object)
+            for i, s in self.decoder.items():
+                cached[i] = s
+            self._decoder_array = cached
+        return cached
+
 
 class IdMapper(object):
     """Map lists of words to lists of ints."""
@@ -48,13 +65,44 @@ class IdMapper(object):
         return len(self.ids.encoder)
 
     def fit(self, sents):
-        """Prepare model by collecting counts from data."""
-        sents = list(sents)
-        for sent in sents:
-            for word in set(sent):
-                self.freq[word] = self.freq.get(word, 0) + 1
-
-    #FIXME .fit(); .transform() should have the same effect as .fit_transform()
+        """Prepare model by collecting counts from data, and assigning ids to
+        words which occur in at least `min_df` sentences."""
+        self._update(*document_frequencies(enumerate(sents)))
+
+    def fit_file(self, path, workers=1):
+        """Like `fit` applied to the whitespace-tokenized lines of file `path`.
+        Counting is split among `workers` processes by byte ranges of the
+        file. The result does not depend on the number of workers."""
+        size = os.path.getsize(path)
+        bounds = [ size * k // workers for k in range(workers+1) ]
+        ranges = [ (path, bounds[k], bounds[k+1]) for k in range(workers) ]
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            try:
+                counts = pool.map(count_range, ranges)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            counts = [ count_range(r) for r in ranges ]
+        freq = {}
+        first = {}
+        for part_freq, part_first in counts:
+            for word, n in part_freq.items():
+                freq[word] = freq.get(word, 0) + n
+            for word, pos in part_first.items():
+                if word not in first or pos < first[word]:
+                    first[word] = pos
+        self._update(freq, first)
+
+    def _update(self, freq, first):
+        """Add counts in `freq`, and assign ids to words in order of their
+        first occurrence `first`, as `_transform` would."""
+        for word, n in freq.items():
+            self.freq[word] = self.freq.get(word, 0) + n
+        for word in sorted(first, key=first.get):
+            if self.freq[word] >= self.min_df:
+                self.ids.to_id(word)
 
     def fit_transform(self, sents):
         """Map each word in sents to a unique int, adding new words."""
@@ -82,6 +130,280 @@ class IdMapper(object):
         for sent in sents:
             yield [ self.ids.from_id(i) for i in sent ]
 
+    def fit_transform_flat(self, sents):
+        """Like `fit_transform`, but return the result as by `transform_flat`."""
+        sents = list(sents)
+        self.fit(sents)
+        return self._transform_flat(sents, update=True)
+
+    def transform_flat(self, sents):
+        """Map each word in sents to a unique int, without adding new words.
+        Return an int32 array of the ids of all words, and an array of
+        offsets such that the ids of sentence i are ids[offsets[i]:offsets[i+1]].
+        """
+        return self._transform_flat(sents, update=False)
+
+    def _transform_flat(self, sents, update=False):
+        sents = list(sents)
+        offsets = np.zeros(len(sents)+1, dtype='int64')
+        np.cumsum([ len(sent) for sent in sents ], out=offsets[1:])
+        if offsets[-1] == 0:
+            return (np.zeros(0, dtype='int32'), offsets)
+        words = list(itertools.chain.from_iterable(sents))
+        # Look up each distinct word once, in order of first occurrence,
+        # so that new ids are assigned in the same order as by `_transform`.
+        lookup = {}
+        for word in collections.OrderedDict.fromkeys(words):
+            [lookup[word]] = next(self._transform([[word]], update=update))
+        return (np.fromiter(map(lookup.__getitem__, words), dtype='int32', count=len(words)), offsets)
+
+    def frequencies(self):
+        """Return array of the document frequencies of words, indexed by id."""
+        return np.array([ self.freq.get(self.ids.from_id(i), 0) for i in range(self.size()) ], dtype='int64')
+
+    def inverse_transform_flat(self, ids, offsets):
+        """Map ids in the format returned by `transform_flat` back to lists of words."""
+        words = self.ids.decoder_array()[ids]
+        for i in range(len(offsets)-1):
+            yield words[offsets[i]:offsets[i+1]].tolist()
+
+
+VOCAB_MAGIC = b'FUNKVOC1'
+
+def save_vocab(mapper, path):
+    """Save IdMapper `mapper` in the binary format read by `MappedIdMapper`.
+
+    The file consists of a magic string, a header of int64 fields (number of
+    ids, min_df, BEG_ID, END_ID, UNK_ID, length of string table), followed by
+    the int64 offsets of each word in the string table, the int64 frequency
+    of each word, the int32 ids sorted by word, and the UTF-8 string table
+    with words in order of id.
+    """
+    n = mapper.ids.max
+    words = [ mapper.ids.from_id(i) for i in range(n) ]
+    encoded = [ w if isinstance(w, bytes) else w.encode('utf-8') for w in words ]
+    offsets = np.zeros(n+1, dtype='<i8')
+    np.cumsum([ len(w) for w in encoded ], out=offsets[1:])
+    freq = np.array([ mapper.freq.get(w, 0) for w in words ], dtype='<i8')
+    by_word = np.array(sorted(range(n), key=encoded.__getitem__), dtype='<i4')
+    header = np.array([n, mapper.min_df, mapper.BEG_ID, mapper.END_ID, mapper.UNK_ID, offsets[-1]], dtype='<i8')
+    with open(path, 'wb') as f:
+        f.write(VOCAB_MAGIC)
+        for a in [header, offsets, freq, by_word]:
+            f.write(a.tobytes())
+        f.write(b''.join(encoded))
+
+class MappedIdTable(object):
+    """Read-only IdTable backed by a memory-mapped file written by `save_vocab`.
+    Processes which map the same file share its pages."""
+    def __init__(self, data, n, start, strings_size):
+        # Plain array views of the mapped file are faster to index than memmaps
+        data = data.view(np.ndarray)
+        self.max = n
+        self.offsets = data[start:start+8*(n+1)].view('<i8')
+        start += 8*(n+1)
+        self.freq = data[start:start+8*n].view('<i8')
+        start += 8*n
+        self.by_word = data[start:start+4*n].view('<i4')
+        start += 4*n
+        self.strings = data[start:start+strings_size]
+
+    def _bytes(self, i):
+        return self.strings[self.offsets[i]:self.offsets[i+1]].tobytes()
+
+    def max_length(self):
+        """Return the length in bytes of the longest word."""
+        if getattr(self, '_max_length', None) is None:
+            self._max_length = int(np.diff(self.offsets).max()) if self.max > 0 else 0
+        return self._max_length
+
+    def lookup(self, words, default):
+        """Return int32 array of the ids of `words`, with `default` for words
+        not in the table. All words are looked up at once, by a binary search
+        in the ids sorted by word which compares the UTF-8 bytes of each word
+        with those of the mapped string table."""
+        encoded = [ w if isinstance(w, bytes) else w.encode('utf-8') for w in words ]
+        if self.max == 0 or not encoded:
+            return np.full(len(encoded), default, dtype='int32')
+        lengths = np.array([ len(w) for w in encoded ], dtype='int64')
+        # Words longer than every word in the table are not looked up
+        width = int(min(lengths.max(), self.max_length())) + 1
+        cols = np.arange(width)
+        data = np.frombuffer(b''.join(encoded), dtype='uint8')
+        starts = np.cumsum(lengths) - lengths
+        inside = cols[None, :] < np.minimum(lengths, width)[:, None]
+        query = np.zeros((len(encoded), width), dtype='uint8')
+        query[inside] = data[(starts[:, None] + cols[None, :])[inside]]
+        lo = np.zeros(len(encoded), dtype='int64')
+        hi = np.full(len(encoded), self.max, dtype='int64')
+        while (lo < hi).any():
+            mid = (lo + hi) // 2
+            active = lo < hi
+            less = self._less(np.minimum(mid, self.max - 1), query, lengths, cols)
+            lo = np.where(active & less, mid + 1, lo)
+            hi = np.where(active & ~less, mid, hi)
+        pos = np.minimum(lo, self.max - 1)
+        found = (lo < self.max) & self._equal(pos, query, lengths, cols)
+        return np.where(found, self.by_word[pos], default).astype('int32')
+
+    def _key(self, pos, cols):
+        """Return the first bytes of the words at positions `pos` of the
+        sorted order, padded with zeros, and their lengths."""
+        ids = self.by_word[pos]
+        start, end = self.offsets[ids], self.offsets[ids+1]
+        index = start[:, None] + cols[None, :]
+        inside = index < end[:, None]
+        key = np.where(inside, self.strings[np.minimum(index, len(self.strings) - 1)], 0)
+        return (key, end - start)
+
+    def _less(self, pos, query, lengths, cols):
+        """Whether the words at `pos` sort before the query words."""
+        key, key_lengths = self._key(pos, cols)
+        differ = key != query
+        first = differ.argmax(axis=1)
+        rows = np.arange(len(pos))
+        # Equal padded bytes mean one word is a prefix of the other, up to trailing NULs
+        return np.where(differ.any(axis=1), key[rows, first] < query[rows, first], key_lengths < lengths)
+
+    def _equal(self, pos, query, lengths, cols):
+        key, key_lengths = self._key(pos, cols)
+        return (key == query).all(axis=1) & (key_lengths == lengths)
+
+    def to_id(self, s, default=None):
+        [i] = self.lookup([s], -1)
+        if i != -1:
+            return int(i)
+        elif default is not None:
+            return default
+        else:
+            raise KeyError("Cannot add {} to read-only MappedIdTable".format(s))
+
+    def from_id(self, i):
+        """Return word `i` as `str`, like IdTable: bytes in Python 2, text in Python 3."""
+        word = self._bytes(i)
+        return word if str is bytes else word.decode('utf-8')
+
+    def decoder_array(self):
+        """Return array of objects indexed by id."""
+        cached = getattr(self, '_decoder_array', None)
+        if cached is None:
+            cached = np.array([ self.from_id(i) for i in range(self.max) ] , dtype=object)
+            self._decoder_array = cached
+        return cached
+
+class MappedFreq(object):
+    """Document frequencies of words in a MappedIdTable."""
+    def __init__(self, ids):
+        self.ids = ids
+
+    def get(self, word, default=None):
+        i = self.ids.to_id(word, default=-1)
+        return default if i == -1 else int(self.ids.freq[i])
+
+class MappedIdMapper(IdMapper):
+    """Read-only IdMapper loaded from a file written by `save_vocab`."""
+    def __init__(self, path):
+        self.path = path
+        data = np.memmap(path, dtype='uint8', mode='r')
+        if data[:len(VOCAB_MAGIC)].tobytes() != VOCAB_MAGIC:
+            raise ValueError("{} is not a vocabulary file".format(path))
+        start = len(VOCAB_MAGIC)
+        n, self.min_df, self.BEG_ID, self.END_ID, self.UNK_ID, strings_size = \
+            [ int(x) for x in data[start:start+48].view('<i8') ]
+        self.ids = MappedIdTable(data, n, start+48, strings_size)
+        self.freq = MappedFreq(self.ids)
+        self.BEG = self.ids.from_id(self.BEG_ID)
+        self.END = self.ids.from_id(self.END_ID)
+        self.UNK = self.ids.from_id(self.UNK_ID)
+
+    def __getstate__(self):
+        return dict(path=self.path)
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def size(self):
+        return self.ids.max
+
+    def frequencies(self):
+        return np.array(self.ids.freq)
+
+    def lookup(self, words):
+        """Return int32 array of ids of `words`, with UNK_ID for unknown words
+        and words in fewer than `min_df` sentences."""
+        ids = self.ids.lookup(words, self.UNK_ID)
+        return np.where(self.ids.freq[ids] < self.min_df, self.UNK_ID, ids).astype('int32')
+
+    def _transform(self, sents, update=False):
+        sents = iter(sents)
+        while True:
+            chunk = list(itertools.islice(sents, 1000))
+            if not chunk:
+                return
+            ids, offsets = self._transform_flat(chunk)
+            for i in range(len(chunk)):
+                yield ids[offsets[i]:offsets[i+1]].tolist()
+
+    def _transform_flat(self, sents, update=False):
+        sents = list(sents)
+        offsets = np.zeros(len(sents)+1, dtype='int64')
+        np.cumsum([ len(sent) for sent in sents ], out=offsets[1:])
+        words = list(itertools.chain.from_iterable(sents))
+        # Look up each distinct word once, all at the same time
+        distinct = list(set(words))
+        lookup = dict(zip(distinct, self.lookup(distinct).tolist()))
+        return (np.fromiter(map(lookup.__getitem__, words), dtype='int32', count=len(words)), offsets)
+
+    def fit(self, sents):
+        raise NotImplementedError("MappedIdMapper is read-only")
+
+    def fit_file(self, path, workers=1):
+        raise NotImplementedError("MappedIdMapper is read-only")
+
+    def fit_transform(self, sents):
+        raise NotImplementedError("MappedIdMapper is read-only")
+
+    def fit_transform_flat(self, sents):
+        raise NotImplementedError("MappedIdMapper is read-only")
+
+def document_frequencies(sents):
+    """Count the number of sentences each word occurs in, given `sents` as
+    pairs of a position and a list of words. Return the counts, and the
+    position of the first occurrence of each word as a pair of the sentence
+    position and the index of the word in the sentence."""
+    freq = {}
+    first = {}
+    for pos, sent in sents:
+        for word in set(sent):
+            n = freq.get(word)
+            if n is None:
+                freq[word] = 1
+                first[word] = (pos, sent.index(word))
+            else:
+                freq[word] = n + 1
+    return (freq, first)
+
+def count_range(args):
+    """Return `document_frequencies` of the lines of a file starting within
+    a byte range, with byte offsets of lines as positions."""
+    path, start, end = args
+    with open(path, 'rb') as f:
+        if start > 0:
+            # Skip the line started by the previous range
+            f.seek(start - 1)
+            f.readline()
+        def lines():
+            pos = f.tell()
+            while pos < end:
+                line = f.readline()
+                if not line:
+                    break
+                yield (pos, decode(line).split())
+                pos = f.tell()
+        return document_frequencies(lines())
+
+def decode(line):
+    return line if isinstance(line, str) else line.decode('utf-8')
 
 def shared0s(shape, dtype=theano.config.floatX, name=None):
     return sharedX(np.zeros(shape), dtype=dtype, name=name)
@@ -165,14 +487,51 @@ def softmax3d(inp):
     result = softmax(x)
     return result.reshape(inp.shape)
 
+def log_softmax3d(inp):
+    x = inp.reshape((inp.shape[0]*inp.shape[1],inp.shape[2]))
+    return log_softmax(x).reshape(inp.shape)
+
 def softmax(x):
     e_x = T.exp(x - x.max(axis=1).dimshuffle(0, 'x'))
     return e_x / e_x.sum(axis=1).dimshuffle(0, 'x')
 
+def log_softmax(x):
+    x = x - x.max(axis=1).dimshuffle(0, 'x')
+    return x - T.log(T.exp(x).sum(axis=1)).dimshuffle(0, 'x')
+
 epsilon = 1e-7
 
-def CrossEntropy(y_true, y_pred):
-    return T.nnet.categorical_crossentropy(T.clip(y_pred, epsilon, 1.0-epsilon), y_true).mean()
+def CrossEntropy(y_true, y_pred, mask=None):
+    """Categorical cross-entropy. If `mask` is given, only positions
+    where it is non-zero count toward the mean."""
+    ce = T.nnet.categorical_crossentropy(T.clip(y_pred, epsilon, 1.0-epsilon), y_true)
+    if mask is None:
+        return ce.mean()
+    else:
+        return (ce * mask).sum() / mask.sum()
+
+def masked_mean(x, mask=None):
+    """Mean of `x`, counting only positions where `mask` is non-zero if given."""
+    if mask is None:
+        return x.mean()
+    else:
+        return (x * mask.flatten()).sum() / mask.sum()
+
+def SparseCrossEntropy(y_true, log_pred, mask=None):
+    """Categorical cross-entropy of integer targets `y_true` given
+    log-probabilities `log_pred`, with one more dimension than `y_true`.
+    If `mask` is given, only positions where it is non-zero count toward
+    the mean."""
+    lp = log_pred.reshape((-1, log_pred.shape[-1]))
+    return masked_mean(-lp[T.arange(lp.shape[0]), y_true.flatten()], mask)
+
+def SoftmaxCrossEntropy(y_true, logits, mask=None):
+    """Like `SparseCrossEntropy` applied to the softmax of `logits`, without
+    computing the probabilities."""
+    x = logits.reshape((-1, logits.shape[-1]))
+    x = x - x.max(axis=1).dimshuffle(0, 'x')
+    ce = T.log(T.exp(x).sum(axis=1)) - x[T.arange(x.shape[0]), y_true.flatten()]
+    return masked_mean(ce, mask)
 
 def BinaryCrossEntropy(y_true, y_pred):
     return T.nnet.binary_crossentropy(T.clip(y_pred, epsilon, 1.0-epsilon), y_true).mean()
@@ -186,7 +545,14 @@ def CosineDistance(U, V):
     W = (U_norm * V_norm).sum(axis=1)
     return (1 - W).mean()
 
-def contrastive(i, s, margin=0.2):
+def contrastive(i, s, margin=0.2, chunk=None, hard=None):
+        """Contrastive hinge loss between matching rows of `i` and `s`,
+        averaged over all pairs. If `chunk` is given, the loss is computed
+        in blocks of `chunk` rows, so that the similarity matrix is never
+        held whole. If `hard` is given, only the `hard` largest violations
+        for each image and for each sentence are counted."""
+        if chunk is not None or hard is not None:
+            return contrastive_chunked(i, s, margin=margin, chunk=chunk, hard=hard)
         # i: (fixed) image embedding,
         # s: sentence embedding
         errors = - cosine_matrix(i, s)
@@ -201,10 +567,41 @@ def contrastive(i, s, margin=0.2):
 
         return cost_tot.mean()
 
+def contrastive_chunked(i, s, margin=0.2, chunk=None, hard=None):
+    """Like `contrastive`, scanning over blocks of `chunk` rows (all rows
+    if None), so that memory grows as chunk x B rather than B x B."""
+    I = normalize(i)
+    S = normalize(s)
+    # Similarity of each image to its own sentence
+    diagonal = (I * S).sum(axis=1)
+    size = i.shape[0] if chunk is None else chunk
+    starts = T.arange(0, i.shape[0], size)
+    def violations(U, V, start):
+        """Similarities and violations of rows start:start+size of U against V, diagonal excluded."""
+        C = T.dot(U[start:start+size], V.T)
+        rows = T.arange(start, start + C.shape[0])
+        off = T.neq(rows.dimshuffle(0, 'x'), T.arange(V.shape[0]).dimshuffle('x', 0))
+        return (C, off, T.maximum(0, margin + C - diagonal[start:start+size].dimshuffle(0, 'x')) * off)
+    def block(start):
+        C, off, cost_i = violations(I, S, start)
+        cost_s = T.maximum(0, margin + C - diagonal.dimshuffle('x', 0)) * off
+        return cost_i.sum() + cost_s.sum()
+    def block_hard(start, U, V):
+        _, _, cost = violations(U, V, start)
+        return T.sort(cost, axis=1)[:, -hard:].sum()
+    if hard is None:
+        sums, _ = theano.scan(block, sequences=[starts])
+    else:
+        sums_i, _ = theano.scan(block_hard, sequences=[starts], non_sequences=[I, S])
+        sums_s, _ = theano.scan(block_hard, sequences=[starts], non_sequences=[S, I])
+        sums = T.concatenate([sums_i, sums_s])
+    return sums.sum() / T.sqr(i.shape[0])
+
+def normalize(U):
+    return U / U.norm(2,  axis=1).reshape((U.shape[0], 1))
+
 def cosine_matrix(U, V):
-    U_norm = U / U.norm(2,  axis=1).reshape((U.shape[0], 1))
-    V_norm = V / V.norm(2, axis=1).reshape((V.shape[0], 1))
-    return T.dot(U_norm, V_norm.T)
+    return T.dot(normalize(U), normalize(V).T)
 
 def clip_norms(gs, max_norm):
     def clip_norm(g, max_norm, norm):
@@ -212,37 +609,118 @@ def clip_norms(gs, max_norm):
     norm = T.sqrt(sum([T.sum(g**2) for g in gs]))
     return [clip_norm(g, max_norm, norm) for g in gs]
 
+def row_indexed(params, cost):
+    """Map those of `params` which are used in the graph of `cost` only
+    by indexing rows (as in Embedding) to the list of indexing nodes.
+    Uses of their shape only, as in indexing with a matrix, are allowed."""
+    uses = dict((p, []) for p in params)
+    for node in theano.gof.graph.io_toposort(theano.gof.graph.inputs([cost]), [cost]):
+        for j, x in enumerate(node.inputs):
+            if x in uses and uses[x] is not None:
+                if isinstance(node.op, T.subtensor.AdvancedSubtensor1) and j == 0:
+                    uses[x].append(node)
+                elif not isinstance(node.op, (theano.compile.ops.Shape, theano.compile.ops.Shape_i)):
+                    uses[x] = None
+    return dict((p, nodes) for p, nodes in uses.items() if nodes)
+
 class Adam(object):
-    """Adam: a Method for Stochastic Optimization, Kingma and Ba. http://arxiv.org/abs/1412.6980."""
+    """Adam: a Method for Stochastic Optimization, Kingma and Ba. http://arxiv.org/abs/1412.6980.
+
+    If `flat` is True, the moment estimates of all parameters are stored
+    in two flat buffers, and updated by a single elementwise operation.
+    If `sparse` is True, parameters which are only used by indexing rows,
+    such as the embeddings of an Embedding layer, are updated lazily:
+    only the rows indexed in the minibatch, and their moment estimates,
+    are updated.
+
+    `get_updates` differentiates `cost`, unless the gradients are given
+    as `grads`, for example as inputs of a function applying gradients
+    computed elsewhere; sparse updates need the cost, and raise ValueError
+    if no parameter qualifies (such as embeddings also used by a tied
+    output layer).
+    """
 
-    def __init__(self, lr=0.0002, b1=0.1, b2=0.001, e=1e-8, max_norm=None):
+    def __init__(self, lr=0.0002, b1=0.1, b2=0.001, e=1e-8, max_norm=None, flat=False, sparse=False):
         autoassign(locals())
 
-    def get_updates(self, params, cost, disconnected_inputs='raise'):
+    def __setstate__(self, state):
+        state.setdefault('flat', False)
+        state.setdefault('sparse', False)
+        self.__dict__.update(state)
+
+    def get_updates(self, params, cost, disconnected_inputs='raise', grads=None):
         updates = []
-        grads = T.grad(cost, params, disconnected_inputs=disconnected_inputs) \
-                             if self.max_norm is None \
-                             else clip_norms(T.grad(cost, params, disconnected_inputs=disconnected_inputs),
-                                             self.max_norm)
+        if grads is not None and self.sparse:
+            raise ValueError("Sparse updates need the cost, not gradients")
+        sparse = row_indexed(params, cost) if self.sparse else {}
+        if self.sparse and not sparse:
+            raise ValueError("Sparse updates requested, but no parameter is used only by indexing rows")
+        dense = [ p for p in params if p not in sparse ]
+        rows = [ node.outputs[0] for p in params if p in sparse for node in sparse[p] ]
+        if grads is None:
+            grads = T.grad(cost, dense + rows, disconnected_inputs=disconnected_inputs)
+        if self.max_norm is not None:
+            grads = clip_norms(grads, self.max_norm)
 
         i = theano.shared(floatX(0.))
         i_t = i + 1.
         fix1 = 1. - self.b1**(i_t)
         fix2 = 1. - self.b2**(i_t)
         lr_t = self.lr * (T.sqrt(fix2) / fix1)
-        for p, g in zip(params, grads):
-            m = theano.shared(p.get_value() * 0.)
-            v = theano.shared(p.get_value() * 0.)
-            m_t = (self.b1 * g) + ((1. - self.b1) * m)
-            v_t = (self.b2 * T.sqr(g)) + ((1. - self.b2) * v)
-            g_t = m_t / (T.sqrt(v_t) + self.e)
-            p_t = p - (lr_t * g_t)
-            updates.append((m, m_t))
-            updates.append((v, v_t))
-            updates.append((p, p_t))
+        if self.flat:
+            updates.extend(self._flat_updates(dense, grads[:len(dense)], lr_t))
+        else:
+            for p, g in zip(dense, grads):
+                updates.extend(self._updates(p, g, lr_t))
+        row_grads = grads[len(dense):]
+        for p in params:
+            if p in sparse:
+                n = len(sparse[p])
+                updates.extend(self._sparse_updates(p, sparse[p], row_grads[:n], lr_t))
+                row_grads = row_grads[n:]
         updates.append((i, i_t))
         return updates
 
+    def _moments(self, g, m, v):
+        m_t = (self.b1 * g) + ((1. - self.b1) * m)
+        v_t = (self.b2 * T.sqr(g)) + ((1. - self.b2) * v)
+        return (m_t, v_t, m_t / (T.sqrt(v_t) + self.e))
+
+    def _updates(self, p, g, lr_t):
+        m = theano.shared(p.get_value() * 0.)
+        v = theano.shared(p.get_value() * 0.)
+        m_t, v_t, g_t = self._moments(g, m, v)
+        return [(m, m_t), (v, v_t), (p, p - (lr_t * g_t))]
+
+    def _flat_updates(self, params, grads, lr_t):
+        if not params:
+            return []
+        shapes = [ p.get_value(borrow=True).shape for p in params ]
+        sizes = [ int(np.prod(shape)) for shape in shapes ]
+        m = theano.shared(np.zeros(sum(sizes), dtype=theano.config.floatX))
+        v = theano.shared(np.zeros(sum(sizes), dtype=theano.config.floatX))
+        m_t, v_t, g_t = self._moments(T.concatenate([ g.flatten() for g in grads ]), m, v)
+        step = lr_t * g_t
+        updates = [(m, m_t), (v, v_t)]
+        offset = 0
+        for p, shape, size in zip(params, shapes, sizes):
+            updates.append((p, p - step[offset:offset+size].reshape(shape)))
+            offset += size
+        return updates
+
+    def _sparse_updates(self, p, nodes, grads, lr_t):
+        m = theano.shared(p.get_value() * 0.)
+        v = theano.shared(p.get_value() * 0.)
+        idx = T.concatenate([ node.inputs[1] for node in nodes ])
+        rows, inverse = T.extra_ops.Unique(return_inverse=True)(idx)
+        # Sum gradients of repeated rows
+        g = T.inc_subtensor(T.zeros([rows.shape[0]] + [ p.shape[j] for j in range(1, p.ndim) ], dtype=p.dtype)[inverse],
+                            T.concatenate(grads))
+        m_t, v_t, g_t = self._moments(g, m[rows], v[rows])
+        return [(m, T.set_subtensor(m[rows], m_t)),
+                (v, T.set_subtensor(v[rows], v_t)),
+                (p, T.inc_subtensor(p[rows], -lr_t * g_t))]
+
 def autoassign(locs):
     """Assign locals to self."""
     for key in locs.keys():
@@ -255,6 +733,146 @@ def pad(xss, padding):
         return xs + [ padding for _ in range(0,(max_len-len(xs))) ]
     return [ pad_one(xs) for xs in xss ]
 
+def pad_mask(xss, padding):
+    """Pad sequences in xss to the same length. Return padded sequences
+    and a mask with 1 at real positions and 0 at padding."""
+    max_len = max((len(xs) for xs in xss))
+    mask = [ [1.0] * len(xs) + [0.0] * (max_len-len(xs)) for xs in xss ]
+    return (pad(xss, padding), mask)
+
+class BucketBatcher(object):
+    """Group items of similar length into minibatches.
+
+    Items are assigned to buckets spanning `width` consecutive lengths, and
+    each bucket is cut into minibatches with at most `max_tokens` padded
+    tokens and at most `batch_size` items. Counts of real and padded
+    tokens emitted are kept in order to report padding efficiency.
+    """
+    def __init__(self, width=5, max_tokens=None, batch_size=128, key=len, shuffle=True):
+        autoassign(locals())
+        self.reset()
+
+    def reset(self):
+        """Reset token counts."""
+        self.real = 0
+        self.padded = 0
+
+    def efficiency(self):
+        """Ratio of real tokens to padded tokens in the minibatches emitted so far."""
+        return self.real / float(self.padded) if self.padded > 0 else 1.0
+
+    def batches(self, items):
+        """Return list of minibatches from items."""
+        buckets = {}
+        for item in items:
+            buckets.setdefault(self.key(item) // self.width, []).append(item)
+        result = []
+        for b in sorted(buckets):
+            bucket = buckets[b]
+            if self.shuffle:
+                random.shuffle(bucket)
+            # Longest first, so that the first item fixes the padded length
+            bucket.sort(key=self.key, reverse=True)
+            mb = []
+            for item in bucket:
+                max_len = self.key(mb[0]) if mb else self.key(item)
+                full = len(mb) == self.batch_size or \
+                       (self.max_tokens is not None and (len(mb) + 1) * max_len > self.max_tokens)
+                if mb and full:
+                    result.append(mb)
+                    mb = []
+                mb.append(item)
+            if mb:
+                result.append(mb)
+        if self.shuffle:
+            random.shuffle(result)
+        return result
+
+    def __call__(self, items):
+        """Yield minibatches from items, counting real and padded tokens."""
+        for mb in self.batches(items):
+            lens = [ self.key(item) for item in mb ]
+            self.real += sum(lens)
+            self.padded += max(lens) * len(lens)
+            yield mb
+
+# The function applied by a Prefetcher worker process
+_worker_fn = None
+
+def _install(fn):
+    global _worker_fn
+    _worker_fn = fn
+
+def _apply(item):
+    return _worker_fn(item)
+
+class Prefetcher(object):
+    """Apply `fn` to items in the background, keeping up to `size` results
+    in preparation while the consumer works on the current one.
+
+    Work is done by `workers` threads, or processes if `processes` is True.
+    Processes receive `fn` once when they start (inherited when forked,
+    otherwise pickled), and then only the items. Results are yielded in the order
+    of items. The number of times the consumer had to wait for a result,
+    and the total time waited, are kept in `starved` and `wait_time`.
+    """
+    def __init__(self, fn, size=4, workers=1, processes=False):
+        autoassign(locals())
+        self.pool = None
+        self.reset()
+
+    def reset(self):
+        """Reset starvation counts."""
+        self.starved = 0
+        self.wait_time = 0.0
+        self.count = 0
+
+    def starvation(self):
+        """Fraction of results which were not ready when requested."""
+        return self.starved / float(self.count) if self.count > 0 else 0.0
+
+    def _pool(self):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers, initializer=_install, initargs=(self.fn,)) if self.processes \
+                        else multiprocessing.pool.ThreadPool(self.workers)
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['pool'] = None
+        return state
+
+    def _get(self, result):
+        self.count += 1
+        if not result.ready():
+            self.starved += 1
+            start = time.time()
+            result.wait()
+            self.wait_time += time.time() - start
+        return result.get()
+
+    def __call__(self, items):
+        """Yield `fn` applied to each of `items`, in order."""
+        if self.size == 0:
+            for item in items:
+                yield self.fn(item)
+            return
+        pool = self._pool()
+        fn = _apply if self.processes else self.fn
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.apply_async(fn, (item,)))
+            if len(pending) > self.size:
+                yield self._get(pending.popleft())
+        while pending:
+            yield self._get(pending.popleft())
+
 def grouper(iterable, n):
         "Collect data into fixed-length chunks or blocks"
         # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx
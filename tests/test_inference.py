@@ -0,0 +1,104 @@
+# encoding: utf-8
+"""The NumPy layers of funktional.inference match the Theano layers."""
+import os
+import sys
+import subprocess
+import tempfile
+import numpy
+import theano
+import theano.tensor as T
+import funktional.util as util
+import funktional.layer as layer
+import funktional.rhn as rhn
+import funktional.inference as inference
+
+floatX = theano.config.floatX
+TOL = dict(rtol=1e-4, atol=1e-5)
+
+def seq(batch=3, length=5, size=4):
+    return numpy.random.uniform(-1, 1, (batch, length, size)).astype(floatX)
+
+def mask(batch=3, length=5):
+    m = numpy.ones((batch, length), dtype=floatX)
+    m[1, 3:] = 0
+    m[2, 1:] = 0
+    return m
+
+def assert_same(net, inputs, call=lambda l, *xs: l(*xs)):
+    """Check that `call` gives the same result on `net` and on its NumPy copy."""
+    xs = [ T.TensorType(x.dtype, (False,) * x.ndim)() for x in inputs ]
+    expected = theano.function(xs, call(net, *xs), on_unused_input='ignore')(*inputs)
+    actual = call(inference.convert(net), *inputs)
+    numpy.testing.assert_allclose(actual, expected, **TOL)
+
+def with_mask(l, x, m):
+    return l(x, mask=m)
+
+def test_activations():
+    x = numpy.linspace(-6, 6, 25).astype(floatX)
+    X = T.vector()
+    for name, f in inference.ACTIVATIONS.items():
+        expected = theano.function([X], getattr(util, name)(X))(x)
+        numpy.testing.assert_allclose(f(x), expected, err_msg=name, **TOL)
+
+def test_embedding():
+    net = layer.Embedding(10, 4)
+    inp = numpy.random.randint(0, 10, (3, 5)).astype('int32')
+    assert_same(net, [inp])
+    assert_same(net, [seq()], call=lambda l, x: l.unembed(x))
+
+def test_dense():
+    assert_same(layer.Dense(4, 3), [seq()[:, 0]])
+
+def test_linear():
+    assert_same(rhn.Linear(4, 3), [seq()])
+
+def test_gru():
+    for fused in [False, True]:
+        assert_same(layer.GRUH0(4, 5, fused=fused), [seq(), mask()], call=with_mask)
+        assert_same(layer.GRUH0(4, 5, fused=fused, fixed=True), [seq()])
+
+def test_gru_backward():
+    net = layer.WithH0(layer.Zeros(5), layer.GRU(4, 5, backward=True))
+    assert_same(net, [seq(), mask()], call=with_mask)
+
+def test_bidi_gru():
+    assert_same(layer.BidiGRUH0(4, 5), [seq(), mask()], call=with_mask)
+
+def test_stacked_gru():
+    assert_same(layer.StackedGRUH0(4, 5, depth=3, residual=True), [seq(), mask()], call=with_mask)
+
+def test_composed_residual_dropout():
+    net = layer.ComposedLayer(layer.Residual(layer.GRUH0(5, 5)),
+                              layer.ComposedLayer(layer.Dropout(0.5), layer.GRUH0(4, 5)))
+    assert_same(net, [seq(), mask()], call=with_mask)
+
+def test_rhn():
+    assert_same(rhn.RHN0(4, 5, recur_depth=3), [seq(), mask()], call=with_mask)
+
+def test_stacked_rhn():
+    assert_same(rhn.StackedRHN0(4, 5, depth=2, recur_depth=2), [seq(), mask()], call=with_mask)
+
+def test_attention():
+    assert_same(layer.Attention(4, size=3), [seq()])
+
+def test_encoder_decoder():
+    # As in autoencoder.py; the default GRU decoder repeats its initial state
+    net = layer.EncoderDecoderGRU(4, 5, 4,
+                                  encoder=lambda size_in, size: layer.StackedGRUH0(size_in, size, 2),
+                                  decoder=lambda size_in, size: layer.StackedGRU(size_in, size, 2))
+    assert_same(net, [seq(), seq(), mask(), mask()],
+                call=lambda l, x, y, mx, my: l(x, y, mask_inp=mx, mask_out=my))
+
+def test_load_without_theano():
+    net = inference.convert(layer.StackedGRUH0(4, 5, depth=2))
+    x = seq()
+    path = os.path.join(tempfile.mkdtemp(), 'net.pkl')
+    inference.save(dict(net=net, x=x), path)
+    script = ("import sys; sys.modules['theano'] = None\n"
+              "import numpy, funktional.inference as inference\n"
+              "d = inference.load(sys.argv[1])\n"
+              "numpy.save(sys.argv[1] + '.npy', d['net'](d['x']))\n")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.check_call([sys.executable, '-c', script, path], cwd=root)
+    numpy.testing.assert_allclose(numpy.load(path + '.npy'), net(x))
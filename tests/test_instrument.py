@@ -0,0 +1,36 @@
+# encoding: utf-8
+"""Per-layer profiling with funktional.instrument."""
+import numpy
+import theano
+import theano.tensor as T
+import funktional.layer as layer
+import funktional.rhn as rhn
+from funktional.instrument import Recorder, recording, profile, table, folded
+
+def run(net):
+    x = T.tensor3()
+    rec = Recorder(net=net)
+    with recording(rec):
+        net(x)
+    value = numpy.random.uniform(-1, 1, (2, 6, 4)).astype(theano.config.floatX)
+    stats = profile(rec, [x], [value], reps=1)
+    assert stats
+    assert all(s['time'] >= 0 and s['self_time'] >= 0 for s in stats)
+    table(stats)
+    folded(stats)
+    return dict((s['name'], s) for s in stats)
+
+def test_profile():
+    net = layer.StackedGRUH0(4, 5, depth=2)
+    stats = run(net)
+    assert stats['net']['params'] == layer.param_count(net.params())
+
+def test_profile_rhn():
+    # The Linear layers called in the scan step are not profiled separately
+    stats = run(rhn.StackedRHN0(4, 5, depth=2, recur_depth=2))
+    assert 'net.layer.bottom' in stats
+    assert not any('recurH' in name for name in stats)
+
+def test_profile_checkpoint():
+    stats = run(layer.StackedGRUH0(4, 5, depth=2, checkpoint=2))
+    assert 'net.layer.bottom' in stats
@@ -0,0 +1,52 @@
+# encoding: utf-8
+"""Conversion of parameters between the fused and unfused GRU layouts."""
+import numpy
+import theano
+import theano.tensor as T
+import funktional.layer as layer
+
+floatX = theano.config.floatX
+
+def seq(batch=3, length=5, size=4):
+    return numpy.random.uniform(-1, 1, (batch, length, size)).astype(floatX)
+
+def values(net):
+    return [ p.get_value() for p in net.params() ]
+
+def assert_borrowed(make, call, inputs):
+    """Check that layers made by `make` in either layout compute the same
+    after borrowing the parameters of one in the other layout."""
+    for fused in [False, True]:
+        source, target = make(fused=fused), make(fused=not fused)
+        target.borrow_params(values(source))
+        xs = [ T.TensorType(x.dtype, (False,) * x.ndim)() for x in inputs ]
+        expected = theano.function(xs, call(source, *xs))(*inputs)
+        actual = theano.function(xs, call(target, *xs))(*inputs)
+        numpy.testing.assert_allclose(actual, expected, rtol=1e-5)
+
+def test_stacked_gru():
+    make = lambda fused: layer.StackedGRUH0(4, 5, depth=3, residual=True, fused=fused)
+    assert_borrowed(make, lambda l, x: l(x), [seq()])
+
+def test_bidi_gru():
+    make = lambda fused: layer.BidiGRUH0(4, 5, fused=fused)
+    assert_borrowed(make, lambda l, x: l(x), [seq()])
+
+def test_encoder_decoder():
+    def make(fused):
+        return layer.EncoderDecoderGRU(4, 5, 4,
+                                       encoder=lambda size_in, size: layer.StackedGRUH0(size_in, size, 2, fused=fused),
+                                       decoder=lambda size_in, size: layer.StackedGRU(size_in, size, 2, fused=fused))
+    assert_borrowed(make, lambda l, x, y: l(x, y), [seq(), seq()])
+
+def test_fused_attributes():
+    gru = layer.GRU_gate_activations(4, 5, fused=True)
+    unfused = ['w_z', 'w_r', 'w_h', 'u_z', 'u_r', 'b_z', 'b_r', 'b_h']
+    assert [ name for name in unfused if hasattr(gru, name) ] == []
+    assert set(gru.params()) == set(v for v in vars(gru).values() if isinstance(v, theano.compile.SharedVariable))
+
+def test_same_layout():
+    source, target = layer.StackedGRUH0(4, 5, depth=2), layer.StackedGRUH0(4, 5, depth=2)
+    target.borrow_params(values(source))
+    for p, q in zip(values(source), values(target)):
+        numpy.testing.assert_array_equal(p, q)
@@ -0,0 +1,62 @@
+# encoding: utf-8
+"""Serving a model with micro-batching, through a local client."""
+import threading
+import numpy
+import theano
+import theano.tensor as T
+import funktional.layer as layer
+from funktional.serve import MicroBatcher, Server, Client
+
+def projector():
+    """Return function projecting a padded batch of word ids, given its mask,
+    to the last state of an encoder."""
+    Embed = layer.Embedding(10, 4)
+    Encode = layer.StackedGRUH0(4, 5, depth=2)
+    inp, mask = T.imatrix(), T.matrix()
+    return theano.function([inp, mask], layer.last(Encode(Embed(inp), mask=mask)))
+
+def batch(project, sents):
+    length = max(len(sent) for sent in sents)
+    inp = numpy.array([ sent + [0] * (length - len(sent)) for sent in sents ], dtype='int32')
+    mask = numpy.array([ [1] * len(sent) + [0] * (length - len(sent)) for sent in sents ],
+                       dtype=theano.config.floatX)
+    return project(inp, mask)
+
+def test_server():
+    project = projector()
+    batcher = MicroBatcher(lambda sents: batch(project, sents), max_batch=4, max_latency=0.2, bucket_width=5)
+    server = Server(('localhost', 0), batcher)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    rng = numpy.random.RandomState(0)
+    sents = [ rng.randint(0, 10, length).tolist() for length in [1, 2, 3, 4, 6, 7, 8, 9] * 2 ]
+    results = [None] * len(sents)
+    start = threading.Event()
+    def request(j):
+        client = Client('localhost', server.server_address[1])
+        start.wait()
+        results[j] = client(sents[j])
+        client.close()
+    threads = [ threading.Thread(target=request, args=(j,)) for j in range(len(sents)) ]
+    for t in threads:
+        t.start()
+    start.set()
+    for t in threads:
+        t.join()
+    for sent, result in zip(sents, results):
+        numpy.testing.assert_allclose(result, batch(project, [sent])[0], rtol=1e-5, atol=1e-6)
+    client = Client('localhost', server.server_address[1])
+    stats = client.stats()
+    client.close()
+    server.shutdown()
+    server.server_close()
+    batcher.close()
+    batch_sizes = dict((int(n), c) for n, c in stats['batch_sizes'].items())
+    queue_depths = dict((int(n), c) for n, c in stats['queue_depths'].items())
+    assert stats['requests'] == len(sents)
+    assert sum(n * c for n, c in batch_sizes.items()) == len(sents)
+    assert max(batch_sizes) > 1 and max(batch_sizes) <= 4
+    assert stats['batches'] < len(sents)
+    assert sum(queue_depths.values()) == len(sents)
+    assert max(queue_depths) > 1
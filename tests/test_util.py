@@ -0,0 +1,62 @@
+# encoding: utf-8
+"""Chunked contrastive loss, sparse updates of Adam, and memory-mapped vocabularies."""
+import os
+import tempfile
+import numpy
+import pytest
+import theano
+import theano.tensor as T
+from funktional.layer import Embedding, Dense, Softmax, SampledSoftmax
+from funktional.util import Adam, IdMapper, MappedIdMapper, save_vocab, contrastive, contrastive_chunked
+
+def loss_and_grads(cost, i, s, values):
+    return theano.function([i, s], [cost] + T.grad(cost, [i, s]))(*values)
+
+def test_contrastive_chunked():
+    B = 5
+    i, s = T.matrix(), T.matrix()
+    rng = numpy.random.RandomState(0)
+    values = [ rng.uniform(-1, 1, (B, 4)).astype(theano.config.floatX) for _ in range(2) ]
+    expected = loss_and_grads(contrastive(i, s), i, s, values)
+    # 2 and 3 do not divide B
+    for kwargs in [dict(chunk=None), dict(chunk=1), dict(chunk=2), dict(chunk=3), dict(chunk=B),
+                   dict(chunk=2, hard=B-1), dict(hard=B-1)]:
+        actual = loss_and_grads(contrastive_chunked(i, s, **kwargs), i, s, values)
+        for a, e in zip(actual, expected):
+            numpy.testing.assert_allclose(a, e, rtol=1e-5, atol=1e-7, err_msg=str(kwargs))
+
+def test_sparse_rows():
+    x = T.imatrix()
+    E, D = Embedding(20, 4), Dense(4, 4)
+    cost = SampledSoftmax(E, num_sampled=3).cost(D(E(x)), x)
+    train = theano.function([x], cost, updates=Adam(sparse=True).get_updates(E.params() + D.params(), cost))
+    before = E.E.get_value()
+    inp = numpy.array([[1, 2], [2, 3]], dtype='int32')
+    train(inp)
+    changed = set(numpy.where((E.E.get_value() != before).any(axis=1))[0])
+    # The input rows, and those of the sampled words
+    assert set([1, 2, 3]) <= changed
+    assert len(changed) <= 3 + 3
+
+def test_sparse_tied():
+    x = T.imatrix()
+    E = Embedding(20, 4)
+    cost = Softmax(E).cost(E(x), x)
+    with pytest.raises(ValueError):
+        Adam(sparse=True).get_updates(E.params(), cost)
+
+def test_mapped_id_mapper():
+    words = [u'w{}'.format(i) for i in range(50)] + [u'ünï', u'a', u'ab', u'x' * 40]
+    if str is bytes:
+        words = [ w.encode('utf-8') for w in words ]
+    rng = numpy.random.RandomState(0)
+    sents = [ [ words[i] for i in rng.randint(0, len(words), rng.randint(0, 8)) ] for _ in range(500) ]
+    mapper = IdMapper(min_df=2)
+    mapper.fit(sents)
+    path = os.path.join(tempfile.mkdtemp(), 'mapper.vocab')
+    save_vocab(mapper, path)
+    mapped = MappedIdMapper(path)
+    test = sents[:100] + [[words[0][:1], 'x' * 41, 'ab\x00', '', mapper.BEG, mapper.END]]
+    assert list(mapped.transform(test)) == list(mapper.transform(test))
+    assert list(mapped.inverse_transform(mapper.transform(test))) == list(mapper.inverse_transform(mapper.transform(test)))
+    assert all(type(w) is str for w in next(mapped.inverse_transform([range(mapped.size())])))